@@ -13,8 +13,9 @@ Application is kept compact, with all its core in a single file.
 #### IMPORTS ####
 
 from flask import (
-    Flask, abort, flash, g, jsonify, make_response, redirect, request,
-    render_template, send_from_directory)
+    Flask, Response, abort, before_render_template, flash, g, has_app_context, jsonify,
+    make_response, redirect, request, render_template, send_from_directory, session,
+    stream_with_context, template_rendered)
 from markupsafe import Markup
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from flask_wtf import CSRFProtect
@@ -22,15 +23,19 @@ from flask_wtf import CSRFProtect
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.routing import BaseConverter
 from peewee import *
-from playhouse.db_url import connect as dbconnect
-import datetime, hashlib, html, importlib, json, markdown, os, random, \
-    re, sys, warnings
-from functools import lru_cache, partial
-from urllib.parse import quote
+from playhouse.db_url import connect as dbconnect, schemes as dburl_schemes
+from playhouse.pool import PooledDatabase
+import base64, collections, datetime, difflib, hashlib, html, importlib, io, \
+    json, markdown, math, os, pickle, random, re, sys, threading, time, warnings
+from functools import lru_cache, partial, wraps
+from contextlib import contextmanager
+from array import array
+from urllib.parse import parse_qs, quote, urlencode, urlparse
 from configparser import ConfigParser
 import i18n
 import gzip
 from getpass import getpass
+import click
 import dotenv
 
 __version__ = '0.9-dev'
@@ -90,14 +95,225 @@ def _makelist(l):
     else:
         return []
 
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def encode_cursor(values):
+    '''
+    Make an opaque token out of the sort key of the last item of a page.
+    '''
+    values = [v.isoformat(' ') if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token, fields):
+    '''
+    Inverse of encode_cursor(). Raise ValueError if token is not valid.
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('invalid cursor')
+    return [_cursor_value(f, v) for f, v in zip(fields, values)]
+
+def _cursor_value(field, value):
+    # cursors come from users: check each value against its field
+    if isinstance(field, DateTimeField):
+        if isinstance(value, str):
+            return datetime.datetime.fromisoformat(value)
+    elif isinstance(field, (IntegerField, ForeignKeyField)):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif isinstance(value, (str, int, float)):
+        return value
+    raise ValueError('invalid cursor')
+
+def keyset_paginate(query, fields, cursor=None, limit=50, descending=False):
+    '''
+    Return a page of query ordered by fields, starting after cursor, and
+    the cursor for the next page (None if it is the last one).
+
+    fields must identify a row, e.g. (Page.touched, Page.id).
+    '''
+    if cursor:
+        values = decode_cursor(cursor, fields)
+        cond = None
+        # lexicographic comparison, (a, b) > (x, y)
+        for i in reversed(range(len(fields))):
+            f, v = fields[i], values[i]
+            c = (f < v) if descending else (f > v)
+            cond = c if cond is None else (c | ((f == v) & cond))
+        query = query.where(cond)
+    query = query.order_by(*[f.desc() if descending else f for f in fields]).limit(limit + 1)
+    items = list(query)
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor([items[-1].__data__.get(f.name) for f in fields])
+
+def view_etag(*parts):
+    '''
+    Make an ETag for a page view out of the given parts, and whatever
+    else the rendered view depends on (user, language, theme, Markdown).
+    '''
+    key = parts + (
+        __version__, markdown_version_stamp(), g.lang, request.cookies.get('dark'),
+        current_user.id if current_user.is_authenticated else 0
+    )
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:24]
+
+def render_conditional(etag, last_modified, render, cache_control='no-cache'):
+    '''
+    Answer 304 Not Modified if the client has the current version of the
+    view, otherwise call render() to make the response.
+    '''
+    last_modified = last_modified.astimezone(datetime.timezone.utc).replace(microsecond=0)
+    if '_flashes' in session:
+        # messages are shown once, the view must be rendered
+        not_modified = False
+    elif request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since:
+        not_modified = last_modified <= request.if_modified_since
+    else:
+        not_modified = False
+    resp = Response(status=304) if not_modified else make_response(render())
+    resp.set_etag(etag, weak=True)
+    resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = cache_control
+    resp.vary.add('Cookie')
+    return resp
+
+def keyset_window(query, fields, after=None, before=None, limit=50, descending=False):
+    '''
+    Like keyset_paginate(), but can also go backwards from before.
+    Return (items, prev_cursor, next_cursor).
+    '''
+    if before:
+        items, more = keyset_paginate(query, fields, cursor=before, limit=limit, descending=not descending)
+        items.reverse()
+        prev_cursor = encode_cursor([items[0].__data__.get(f.name) for f in fields]) if more else None
+        next_cursor = encode_cursor([items[-1].__data__.get(f.name) for f in fields]) if items else None
+    else:
+        items, next_cursor = keyset_paginate(query, fields, cursor=after, limit=limit, descending=descending)
+        prev_cursor = encode_cursor([items[0].__data__.get(f.name) for f in fields]) if after and items else None
+    return items, prev_cursor, next_cursor
+
+_count_cache = {}
+
+def cached_count(query):
+    '''
+    Count the rows of a query, remembering the result for
+    [appearance]count_cache_ttl seconds (default 60), or until a page or
+    user is added in this process.
+    '''
+    if not hasattr(query, 'sql'):
+        return query.count()
+    sql, params = query.sql()
+    key = (sql, tuple(params))
+    now = time.monotonic()
+    cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    if len(_count_cache) > 1000:
+        _count_cache.clear()
+    n = query.count()
+    _count_cache[key] = (now + _getconf('appearance', 'count_cache_ttl', 60, cast=int), n)
+    return n
+
+class Pagination(object):
+    '''
+    Position in a paginated listing, for templates. Listings go either
+    by page number (page_n), or by cursors.
+    '''
+    def __init__(self, per_page, total_count=None, page_n=None, n_items=0,
+            prev_cursor=None, next_cursor=None):
+        self.per_page = per_page
+        if page_n and total_count is not None:
+            # cached counts may be behind
+            total_count = max(total_count, (page_n - 1) * per_page + n_items)
+        self.total_count = total_count
+        self.page_n = page_n
+        self.n_items = n_items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+    @property
+    def start(self):
+        if self.page_n:
+            return (self.page_n - 1) * self.per_page + 1
+    @property
+    def end(self):
+        if self.page_n:
+            return (self.page_n - 1) * self.per_page + self.n_items
+    def _url(self, **params):
+        args = request.args.to_dict()
+        for k in ('page', 'after', 'before'):
+            args.pop(k, None)
+        args.update(params)
+        return '?' + urlencode(args)
+    @property
+    def prev_url(self):
+        if self.page_n:
+            return self._url(page=self.page_n - 1) if self.page_n > 1 else None
+        return self._url(before=self.prev_cursor) if self.prev_cursor else None
+    @property
+    def next_url(self):
+        if self.page_n:
+            return self._url(page=self.page_n + 1) if self.page_n * self.per_page < (self.total_count or 0) else None
+        return self._url(after=self.next_cursor) if self.next_cursor else None
+
+def _items_per_page():
+    return _getconf('appearance', 'items_per_page', 20, cast=int)
+
 def render_paginated_template(template_name, query_name, **kwargs):
     query = kwargs.pop(query_name)
-    page = int(request.args.get('page', 1))
-    kwargs[query_name] = query.paginate(page)
+    page = max(1, int(request.args.get('page', 1)))
+    per_page = _items_per_page()
+    if query.model is Page:
+        kwargs[query_name] = Page.prefetch_listing(query.paginate(page, per_page))
+    else:
+        kwargs[query_name] = list(query.paginate(page, per_page))
+    total_count = cached_count(query)
     return render_template(
         template_name,
         page_n = page,
-        total_count = query.count(),
+        total_count = total_count,
+        pagination = Pagination(per_page, total_count, page_n=page, n_items=len(kwargs[query_name])),
+        **kwargs
+    )
+
+def render_keyset_template(template_name, query_name, fields, descending=True, count=True, **kwargs):
+    '''
+    Like render_paginated_template(), but go through the listing with
+    cursors (?after= and ?before=) on fields, e.g. (Page.touched, Page.id).
+    Deep pages cost as much as the first one. With count=False, the
+    total is not counted at all.
+    '''
+    query = kwargs.pop(query_name)
+    per_page = _items_per_page()
+    try:
+        items, prev_cursor, next_cursor = keyset_window(query, fields,
+            after=request.args.get('after'), before=request.args.get('before'),
+            limit=per_page, descending=descending)
+    except ValueError:
+        abort(400)
+    if query.model is Page:
+        items = Page.prefetch_listing(items)
+    kwargs[query_name] = items
+    total_count = cached_count(query) if count else None
+    return render_template(
+        template_name,
+        total_count = total_count,
+        pagination = Pagination(per_page, total_count, n_items=len(items),
+            prev_cursor=prev_cursor, next_cursor=next_cursor),
         **kwargs
     )
 
@@ -133,9 +349,36 @@ class SpoilerExtension(markdown.extensions.Extension):
 
 #### DATABASE SCHEMA ####
 
+def connect_database(url):
+    '''
+    Open the database at url. With [database]pool = 1, or a "+pool" scheme
+    such as mysql+pool://, connections are pooled: closing one gives it back
+    to the pool. Pool settings in the URL query take precedence over
+    [database]max_connections, stale_timeout and pool_timeout.
+    '''
+    scheme, sep, rest = url.partition('://')
+    if (_getconf('database', 'pool', 0, cast=int) and not scheme.endswith('+pool')
+        and scheme + '+pool' in dburl_schemes and ':memory:' not in rest):
+        # an in-memory SQLite database would be a different one on each connection
+        scheme += '+pool'
+    kwargs = {}
+    if scheme.endswith('+pool'):
+        query = parse_qs(urlparse(url).query)
+        for key, conf_key, default in (
+            ('max_connections', 'max_connections', 20),
+            ('stale_timeout', 'stale_timeout', 300),
+            ('timeout', 'pool_timeout', 10)
+        ):
+            if key not in query:
+                kwargs[key] = _getconf('database', conf_key, default, cast=int)
+        if scheme.startswith('sqlite'):
+            # pooled connections move between threads
+            kwargs['check_same_thread'] = False
+    return dbconnect(scheme + sep + rest, **kwargs)
+
 database_url = os.getenv("DATABASE_URL") or _getconf('database', 'url')
 if database_url:
-    database = dbconnect(database_url)
+    database = connect_database(database_url)
 else:
     print("Database URL required.")
     exit(-1)
@@ -177,11 +420,7 @@ class User(BaseModel):
         if self.is_admin:
             return PERM_ALL
 
-        perm = 0
-
-        for gr in self.groups:
-            perm |= gr.permissions
-        
+        group_ids, perm = get_group_perms(self)
         return perm
 
 
@@ -238,18 +477,87 @@ class Page(BaseModel):
     is_math_enabled = flags.flag(4) # legacy, math is no more supported
     is_locked = flags.flag(8)
     is_cw = flags.flag(16)
+    # set on search results
+    search_snippet = None
+    # denormalized, kept up to date by add_revision()
+    latest_revision = DeferredForeignKey('PageRevision', null=True, backref='+')
+    _latest = None
     @property
     def latest(self):
-        if self.revisions:
-            return self.revisions.order_by(PageRevision.pub_date.desc())[0]
+        if self._latest is None:
+            if self.latest_revision_id:
+                self._latest = self.latest_revision
+            else:
+                self._latest = self.revisions.order_by(PageRevision.pub_date.desc(), PageRevision.id.desc()).first()
+        return self._latest
+    @classmethod
+    def prefetch_listing(cls, query):
+        '''
+        Evaluate a query (or list) of pages, loading their tags and latest
+        revisions in a fixed number of queries. Used by listings.
+        '''
+        pages = list(query)
+        tags_by_page = {p.id: [] for p in pages}
+        for tag in PageTag.select().where(PageTag.page.in_(list(tags_by_page))):
+            tags_by_page[tag.page_id].append(tag)
+        for p in pages:
+            # same as prefetch()
+            p.tags = tags_by_page[p.id]
+        rev_ids = [p.latest_revision_id for p in pages if p.latest_revision_id]
+        if not rev_ids:
+            return pages
+        latest_by_id = {rev.id: rev for rev in PageRevision.select().where(PageRevision.id.in_(rev_ids))}
+        for p in pages:
+            if p.latest_revision_id in latest_by_id:
+                p._latest = latest_by_id[p.latest_revision_id]
+        return pages
+    @classmethod
+    def prefetch_perms(cls, pages):
+        '''
+        Load permission overrides of many pages in one query, for the
+        rest of the request.
+        '''
+        cache = _request_cache('page_overrides')
+        ids = [p.id for p in pages if p.id not in cache]
+        for i in ids:
+            cache[i] = []
+        for page_id, group_id, ov_perm in (PagePermission
+                .select(PagePermission.page, PagePermission.group, PagePermission.permissions)
+                .where(PagePermission.page.in_(ids)).tuples()):
+            cache[page_id].append((group_id, ov_perm))
     def get_url(self):
         return '/' + self.url + '/' if self.url else '/p/{}/'.format(self.id)
     def short_desc(self):
         if self.is_cw:
             return '(Content Warning: we are not allowed to show a description.)'
-        full_text = self.latest.text
-        text = remove_tags(full_text, convert = not _getconf('appearance', 'simple_remove_tags', False))
-        return text[:200] + ('\u2026' if len(text) > 200 else '')
+        latest = self.latest
+        if latest.excerpt is None:
+            # revision saved before 0.9, and not backfilled yet
+            return make_excerpt(latest.text)
+        return latest.excerpt
+    def add_revision(self, text, *, user_id, comment='', pub_date=None):
+        '''
+        Save a new revision of this page with the given text.
+        '''
+        latest = self.latest
+        rev = PageRevision.create(
+            page=self,
+            user_id=user_id,
+            comment=comment,
+            textref=PageText.create_content(text, base_id=latest.textref_id if latest else None),
+            pub_date=pub_date or datetime.datetime.now(),
+            length=len(text),
+            excerpt=make_excerpt(text)
+        )
+        _count_cache.clear()
+        if latest is None or rev.pub_date >= latest.pub_date:
+            Page.update(latest_revision=rev).where(Page.id == self.id).execute()
+            self.latest_revision = rev
+            self._latest = rev
+            PageScore.refresh([self.id])
+            search_index.update_page(self, text=text)
+            response_cache.invalidate(self.id, [x.name for x in self.tags])
+        return rev
     def change_tags(self, new_tags):
         old_tags = set(x.name for x in self.tags)
         new_tags = set(new_tags)
@@ -257,6 +565,19 @@ class Page(BaseModel):
             (PageTag.name << (old_tags - new_tags))).execute()
         for tag in (new_tags - old_tags):
             PageTag.create(page=self, name=tag)
+        TagStat.adjust(new_tags - old_tags, old_tags - new_tags)
+        # also refreshes the title in the search index
+        search_index.update_page(self, tags=new_tags)
+        # and title, URL, tags in cached views
+        response_cache.invalidate(self.id, old_tags | new_tags)
+    def tag_popularity(self):
+        '''
+        List (name, number of pages) for each tag of this page.
+        '''
+        names = [x.name for x in self.tags]
+        counts = dict(TagStat.select(TagStat.name, TagStat.count)
+            .where(TagStat.name.in_(names)).tuples())
+        return [(name, counts.get(name, 0)) for name in names]
     def js_info(self):
         latest = self.latest
         return dict(
@@ -281,43 +602,55 @@ class Page(BaseModel):
 
     def can_edit(self, user):
         perm = self.get_perms(user)
-        return perm & PERM_EDIT or (self.owner == user and perm & PERM_CREATE)
+        return perm & PERM_EDIT or (user.is_authenticated and self.owner_id == user.id and perm & PERM_CREATE)
     def is_owned_by(self, user):
-        return user.id == self.owner.id
+        return user.id == self.owner_id
 
     def get_perms(self, user=None):
         if user is None:
             user = current_user
 
         if user.is_anonymous:
-            return UserGroup.get_default_group().permissions & PERM_LOCK
+            return get_group_perms(None)[1] & PERM_LOCK
 
         if user.is_admin:
             return PERM_ALL
 
-        perm = 0
+        cache = _request_cache('page_perms')
+        if (self.id, user.id) in cache:
+            return cache[(self.id, user.id)]
+
         # default groups  
-        for gr in user.groups:
-            perm |= gr.permissions
+        group_ids, perm = get_group_perms(user)
 
         # page overrides
-        for ov in self.permission_overrides:
-            if ov.group in user.groups:
-                perm |= ov.permissions
-
-        if self.is_locked and self.owner.id != user.id:
+        overrides = _request_cache('page_overrides').get(self.id)
+        if overrides is None:
+            overrides = (PagePermission
+                .select(PagePermission.group, PagePermission.permissions)
+                .where(PagePermission.page == self).tuples())
+        for group_id, ov_perm in overrides:
+            if group_id in group_ids:
+                perm |= ov_perm
+
+        if self.is_locked and self.owner_id != user.id:
             perm &= PERM_LOCK
+        cache[(self.id, user.id)] = perm
         return perm
     
+    def invalidate_link_targets(self):
+        '''
+        Drop cached views of the pages this one links to, which show its title.
+        '''
+        response_cache.invalidate_links_to(i for i, in PageLink
+            .select(PageLink.to_page).where(PageLink.from_page == self).tuples())
+
     def seo_keywords(self):
         kw = []
         for tag in self.tags:
             kw.append(tag.name.replace("-", " "))
-        for bkl in self.back_links:
-            try:
-                kw.append(bkl.from_page.title.replace(",", ""))
-            except Exception:
-                pass
+        for bkl in Page.select(Page.title).join(PageLink, on=PageLink.from_page).where(PageLink.to_page == self):
+            kw.append(bkl.title.replace(",", ""))
         return ", ".join(kw)
     
     #def ldjson(self):
@@ -327,34 +660,143 @@ class Page(BaseModel):
     #    }
 
 
+def make_text_delta(base, text):
+    '''
+    Describe text as a list of line ranges [i, j] copied from base,
+    and strings inserted as they are.
+    '''
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    delta = []
+    sm = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        if op == 'equal':
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append(''.join(lines[j1:j2]))
+    return delta
+
+def apply_text_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    chunks = []
+    for item in delta:
+        if isinstance(item, str):
+            chunks.append(item)
+        else:
+            chunks.extend(base_lines[item[0]:item[1]])
+    return ''.join(chunks)
+
 class PageText(BaseModel):
     content = BlobField()
+    # SHA-256 of the UTF-8 text, used to find duplicates
+    digest = CharField(64, null=True, unique=True)
+    # keyframe of a delta, see make_text_delta()
+    base = ForeignKeyField('self', null=True, backref='deltas')
     flags = BitField()
     is_utf8 = flags.flag(1)
     is_gzipped = flags.flag(2)
+    is_delta = flags.flag(4)
     def get_content(self):
         c = self.content
         if self.is_gzipped:
-            c = gzip.decompress(c)
+            with perf_phase('text'):
+                c = gzip.decompress(c)
+        if self.is_delta:
+            return apply_text_delta(_keyframe_text(self.base_id), json.loads(c.decode('utf-8')))
         if self.is_utf8:
             return c.decode('utf-8')
         else:
             return c.decode('latin-1')
     @classmethod
-    def create_content(cls, text, *, treshold=600, search_dup=True):
+    def create_content(cls, text, *, treshold=600, search_dup=True, base_id=None):
+        '''
+        Store text, unless an identical one exists.
+
+        If base_id is given and delta storage is enabled, text may be stored
+        as a delta against that text (or its keyframe).
+        '''
         c = text.encode('utf-8')
-        use_gzip = len(c) > treshold
-        if use_gzip and gzip:
-            c = gzip.compress(c)
+        digest = hashlib.sha256(c).hexdigest()
         if search_dup:
-            item = cls.get_or_none((cls.content == c) & (cls.is_gzipped == use_gzip))
+            item = cls.get_or_none(cls.digest == digest)
             if item:
                 return item
-        return cls.create(
-            content=c,
-            is_utf8=True,
-            is_gzipped=use_gzip
-        )
+        fields = cls._encode(text, treshold=treshold, base_id=base_id)
+        try:
+            with database.atomic():
+                return cls.create(
+                    digest=digest if search_dup else None,
+                    **fields
+                )
+        except IntegrityError:
+            # saved by someone else in the meantime
+            return cls.get(cls.digest == digest)
+    @classmethod
+    def _encode(cls, text, *, treshold=600, base_id=None):
+        level = _getconf('storage', 'compress_level', 9, cast=int)
+        c = text.encode('utf-8')
+        use_gzip = len(c) > treshold
+        if use_gzip and gzip:
+            c = gzip.compress(c, compresslevel=level)
+        fields = dict(content=c, base=None, is_utf8=True, is_gzipped=use_gzip, is_delta=False)
+        if base_id is None or not _getconf('storage', 'deltas', 0, cast=int):
+            return fields
+        base = cls.select(cls.id, cls.base, cls.flags).where(cls.id == base_id).get()
+        if base.is_delta:
+            base_id = base.base_id
+        interval = _getconf('storage', 'keyframe_interval', 20, cast=int)
+        if cls.select().where(cls.base == base_id).count() >= interval - 1:
+            # time for a new keyframe
+            return fields
+        delta = json.dumps(make_text_delta(_keyframe_text(base_id), text), separators=(',', ':'))
+        d = gzip.compress(delta.encode('utf-8'), compresslevel=level)
+        if len(d) < len(c):
+            fields.update(content=d, base=base_id, is_gzipped=True, is_delta=True)
+        return fields
+    # To be called from a maintenance script only!
+    @classmethod
+    def repack(cls):
+        '''
+        Store old revisions of each page as deltas against periodic
+        keyframes. Texts shared by more than one page are left as they are.
+        Return the size of stored texts before and after, in bytes.
+        '''
+        size_before = cls.select(fn.Sum(fn.Length(cls.content))).scalar() or 0
+        shared = set(PageRevision
+            .select(PageRevision.textref)
+            .group_by(PageRevision.textref)
+            .having(fn.Count(fn.Distinct(PageRevision.page)) > 1)
+            .tuples().iterator())
+        # texts to keep whole: shared between pages, or keyframes already
+        shared = {x[0] for x in shared}
+        shared.update(x[0] for x in cls.select(cls.base).where(cls.base.is_null(False)).distinct().tuples())
+        for p in Page.select(Page.id).iterator():
+            with database.atomic():
+                keyframe_id = None
+                for rev in (PageRevision.select(PageRevision.textref)
+                        .where(PageRevision.page == p.id)
+                        .order_by(PageRevision.pub_date, PageRevision.id)):
+                    pt = cls[rev.textref_id]
+                    if pt.is_delta:
+                        keyframe_id = pt.base_id
+                        continue
+                    if pt.id in shared or keyframe_id in (None, pt.id):
+                        keyframe_id = pt.id
+                        continue
+                    fields = cls._encode(pt.get_content(), base_id=keyframe_id)
+                    if fields['is_delta']:
+                        for k, v in fields.items():
+                            setattr(pt, k, v)
+                        pt.save()
+                        shared.add(keyframe_id)
+                    else:
+                        keyframe_id = pt.id
+        size_after = cls.select(fn.Sum(fn.Length(cls.content))).scalar() or 0
+        return size_before, size_after
+
+@lru_cache(maxsize=_getconf('storage', 'keyframe_cache_size', 64, cast=int))
+def _keyframe_text(text_id):
+    return PageText[text_id].get_content()
         
 class PageRevision(BaseModel):
     page = FK(Page, backref='revisions', index=True)
@@ -363,13 +805,39 @@ class PageRevision(BaseModel):
     textref = FK(PageText)
     pub_date = DateTimeField(index=True)
     length = IntegerField()
+    # plain text shown in page listings, see make_excerpt()
+    excerpt = CharField(256, null=True)
+    class Meta:
+        indexes = (
+            (('page', 'pub_date'), False),
+            (('user', 'pub_date'), False),
+        )
+    @classmethod
+    def select_metadata(cls, *extra):
+        '''
+        Select revisions without text or excerpt, with the username of
+        their author. Used by history listings.
+        '''
+        return (cls.select(cls.id, cls.page, cls.user, cls.comment, cls.pub_date, cls.length,
+                User.id, User.username, *extra)
+            .join(User, JOIN.LEFT_OUTER, on=cls.user))
+    def previous_id(self):
+        '''
+        Id of the revision of the same page before this one, or None.
+        '''
+        cls = type(self)
+        return (cls.select(cls.id)
+            .where((cls.page == self.page_id) & (
+                (cls.pub_date < self.pub_date) |
+                ((cls.pub_date == self.pub_date) & (cls.id < self.id))))
+            .order_by(cls.pub_date.desc(), cls.id.desc()).scalar())
     @property
     def text(self):
         return self.textref.get_content()
     def html(self):
-        return md(self.text)
+        return self.html_and_toc()[0]
     def html_and_toc(self):
-        return md_and_toc(self.text)
+        return PageRender.get_or_render(self)
     def human_pub_date(self):
         delta = datetime.datetime.now() - self.pub_date
         T = partial(get_string, g.lang)
@@ -384,6 +852,175 @@ class PageRevision(BaseModel):
             return T('n-days-ago').format(delta.days)
         else:
             return self.pub_date.strftime('%B %-d, %Y')
+    def human_pub_date_period(self):
+        '''
+        Start and end of the time in which human_pub_date() gives the same
+        text, or None if it gives a date, which does not change.
+        '''
+        delta = datetime.datetime.now() - self.pub_date
+        for limit, step in (
+            (datetime.timedelta(seconds=60), datetime.timedelta(seconds=60)),
+            (datetime.timedelta(seconds=3600), datetime.timedelta(seconds=60)),
+            (datetime.timedelta(days=1), datetime.timedelta(seconds=3600)),
+            (datetime.timedelta(days=15), datetime.timedelta(days=1))
+        ):
+            if delta < limit:
+                n = delta // step
+                return self.pub_date + n * step, self.pub_date + (n + 1) * step
+        return None
+
+# Rendered HTML cache. Revisions never change once written, so the
+# output is valid as long as the Markdown configuration is the same.
+class PageRender(BaseModel):
+    revision = FK(PageRevision, primary_key=True, backref='renders')
+    version = CharField(16)
+    html = BlobField()
+    toc = TextField(default='')
+    def get_html(self):
+        return gzip.decompress(self.html).decode('utf-8')
+    @classmethod
+    def get_or_render(cls, rev):
+        stamp = markdown_version_stamp()
+        item = cls.get_or_none((cls.revision == rev) & (cls.version == stamp))
+        if item:
+            return item.get_html(), item.toc
+        try:
+            html, toc = render_markdown(rev.text)
+        except Exception:
+            # do not cache errors
+            return md_and_toc(rev.text)
+        cls.store(rev, html, toc)
+        return html, toc
+    @classmethod
+    def store(cls, rev, html, toc):
+        cls.replace(
+            revision=rev,
+            version=markdown_version_stamp(),
+            html=gzip.compress(html.encode('utf-8')),
+            toc=toc
+        ).execute()
+    # To be called after changing Markdown extensions.
+    @classmethod
+    def rebuild(cls, all_revisions=False):
+        cls.delete().where(cls.version != markdown_version_stamp()).execute()
+        if all_revisions:
+            query = PageRevision.select()
+        else:
+            query = PageRevision.select().where(
+                PageRevision.id.in_(
+                    PageRevision.select(fn.Max(PageRevision.id)).group_by(PageRevision.page)
+                )
+            )
+        n = 0
+        for rev in query.iterator():
+            cls.get_or_render(rev)
+            n += 1
+        return n
+
+# bump when the output of compute_diff() changes
+DIFF_FORMAT_VERSION = 1
+
+_WORD_RE = re.compile(r'\w+|\s+|[^\w\s]')
+
+def _word_diff(old, new):
+    '''
+    Compare two lines word by word. Return lists of [kind, text] segments
+    for each, where kind is '=', '-' or '+'.
+    '''
+    a, b = _WORD_RE.findall(old), _WORD_RE.findall(new)
+    old_segs, new_segs = [], []
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if op == 'equal':
+            old_segs.append(['=', ''.join(a[i1:i2])])
+            new_segs.append(['=', ''.join(b[j1:j2])])
+        else:
+            if i2 > i1:
+                old_segs.append(['-', ''.join(a[i1:i2])])
+            if j2 > j1:
+                new_segs.append(['+', ''.join(b[j1:j2])])
+    return old_segs, new_segs
+
+def compute_diff(old, new, context=3):
+    '''
+    Compare two texts line by line, and changed lines word by word.
+
+    Return (rows, added, removed). Each row is [kind, old line number,
+    new line number, content], where kind is 'ctx', 'del', 'ins' or 'mod'
+    (content is then a pair of segment lists, see _word_diff()), or
+    'skip' for unchanged lines left out (content is their number).
+    '''
+    a, b = old.splitlines(), new.splitlines()
+    rows = []
+    added = removed = 0
+    opcodes = difflib.SequenceMatcher(None, a, b, autojunk=len(a) + len(b) > 20000).get_opcodes()
+    for k, (op, i1, i2, j1, j2) in enumerate(opcodes):
+        if op == 'equal':
+            head = context if k > 0 else 0
+            tail = context if k < len(opcodes) - 1 else 0
+            if i2 - i1 > head + tail:
+                rows.extend(['ctx', i1 + n + 1, j1 + n + 1, a[i1 + n]] for n in range(head))
+                rows.append(['skip', None, None, i2 - i1 - head - tail])
+                rows.extend(['ctx', i2 - tail + n + 1, j2 - tail + n + 1, a[i2 - tail + n]] for n in range(tail))
+            else:
+                rows.extend(['ctx', i1 + n + 1, j1 + n + 1, a[i1 + n]] for n in range(i2 - i1))
+            continue
+        removed += i2 - i1
+        added += j2 - j1
+        if op == 'replace' and i2 - i1 == j2 - j1 and i2 - i1 <= 50:
+            for n in range(i2 - i1):
+                rows.append(['mod', i1 + n + 1, j1 + n + 1, _word_diff(a[i1 + n], b[j1 + n])])
+        else:
+            rows.extend(['del', i1 + n + 1, None, a[i1 + n]] for n in range(i2 - i1))
+            rows.extend(['ins', None, j1 + n + 1, b[j1 + n]] for n in range(j2 - j1))
+    return rows, added, removed
+
+# Diffs between two revisions. Revisions never change, so they are
+# computed once.
+class PageDiff(BaseModel):
+    old = FK(PageRevision, backref='+')
+    new = FK(PageRevision, backref='+')
+    version = IntegerField()
+    added = IntegerField()
+    removed = IntegerField()
+    # gzipped JSON of the rows, see compute_diff()
+    data = BlobField()
+
+    class Meta:
+        primary_key = CompositeKey('old', 'new')
+
+    def get_rows(self):
+        return json.loads(gzip.decompress(self.data))
+
+    @classmethod
+    def compute(cls, old, new):
+        '''
+        Diff two revisions, without storing the result.
+        '''
+        if old.textref_id == new.textref_id:
+            rows, added, removed = [], 0, 0
+        else:
+            rows, added, removed = compute_diff(old.text, new.text)
+        return cls(old=old, new=new, version=DIFF_FORMAT_VERSION, added=added, removed=removed,
+            data=gzip.compress(json.dumps(rows).encode('utf-8')))
+
+    @classmethod
+    def get_or_compute(cls, old, new):
+        '''
+        Diff two revisions. Only diffs of consecutive revisions are stored,
+        others are kept in a bounded cache in memory.
+        '''
+        if new.previous_id() != old.id:
+            return _other_pair_diff(old.id, new.id)
+        item = cls.get_or_none((cls.old == old) & (cls.new == new) & (cls.version == DIFF_FORMAT_VERSION))
+        if item:
+            return item
+        item = cls.compute(old, new)
+        cls.replace(**item.__data__).execute()
+        return item
+
+@lru_cache(maxsize=_getconf('storage', 'diff_cache_size', 128, cast=int))
+def _other_pair_diff(old_id, new_id):
+    return PageDiff.compute(PageRevision[old_id], PageRevision[new_id])
 
 class PageTag(BaseModel):
     page = FK(Page, backref='tags', index=True)
@@ -393,7 +1030,45 @@ class PageTag(BaseModel):
             (('page', 'name'), True),
         )
     def popularity(self):
-        return PageTag.select().where(PageTag.name == self.name).count()
+        stat = TagStat.get_or_none(TagStat.name == self.name)
+        return stat.count if stat else 0
+
+# Number of pages with each tag, updated along with PageTag.
+class TagStat(BaseModel):
+    name = CharField(64, primary_key=True)
+    count = IntegerField(default=0, index=True)
+
+    @classmethod
+    def adjust(cls, added=(), removed=()):
+        '''
+        Count tags added to, or removed from, a page.
+        '''
+        added, removed = set(added), set(removed)
+        with database.atomic():
+            if removed:
+                cls.update(count=cls.count - 1).where(cls.name.in_(list(removed))).execute()
+                cls.delete().where((cls.name.in_(list(removed))) & (cls.count <= 0)).execute()
+            if added:
+                # MySQL upserts on any unique key, and does not take a target
+                target = {} if isinstance(database, MySQLDatabase) else {'conflict_target': [cls.name]}
+                (cls.insert_many([(n, 1) for n in added], fields=[cls.name, cls.count])
+                    .on_conflict(update={cls.count: cls.count + 1}, **target).execute())
+
+    @classmethod
+    def refresh_all(cls):
+        with database.atomic():
+            cls.delete().execute()
+            rows = PageTag.select(PageTag.name, fn.Count(PageTag.id)).group_by(PageTag.name).tuples()
+            for chunk in _chunks(rows, 500):
+                cls.insert_many(chunk, fields=[cls.name, cls.count]).execute()
+
+    @classmethod
+    def complete(cls, prefix, limit=10):
+        '''
+        Most used tags starting with prefix.
+        '''
+        return (cls.select().where(cls.name.startswith(prefix))
+            .order_by(cls.count.desc(), cls.name).limit(limit))
 
 class PageProperty(BaseModel):
     page = ForeignKeyField(Page, backref='page_meta', index=True)
@@ -458,35 +1133,365 @@ class PageLink(BaseModel):
             (('from_page', 'to_page'), True),
         )
 
+    @classmethod
+    def resolve_targets(cls, urls, ids):
+        '''
+        Return the ids of existing pages among the given URLs and ids,
+        and the set of link targets which do not exist.
+        '''
+        found = set()
+        wanted = set(urls) | {'p/{0}'.format(i) for i in ids}
+        for field, values in ((Page.url, urls), (Page.id, ids)):
+            for chunk in _chunks(values, 500):
+                for i, url in Page.select(Page.id, Page.url).where(field.in_(chunk)).tuples():
+                    found.add(i)
+                    wanted.discard(url)
+                    wanted.discard('p/{0}'.format(i))
+        return found, wanted
+
     @classmethod
     def parse_links(cls, from_page, text, erase=True):
+        urls, ids = extract_link_targets(text)
         with database.atomic():
-            old_links = list(cls.select().where(cls.from_page == from_page))
-            for mo in re.finditer(ILINK_RE, text):
-                try:
-                    pageurl = mo.group(1)
-                    if pageurl.startswith('p/'):
-                        to_page = Page[int(pageurl[2:])]
-                    else:
-                        to_page = Page.get(Page.url == pageurl)
-                    
-                    linkobj, created = PageLink.get_or_create(
-                        from_page = from_page,
-                        to_page = to_page)
-                    if linkobj in old_links:
-                        old_links.remove(linkobj)
-                except Exception:
-                    continue
-            if erase:
-                for linkobj in old_links:
-                    linkobj.delete_instance()
+            new_links, wanted = cls.resolve_targets(urls, ids)
+            old_links = {i for i, in cls.select(cls.to_page).where(cls.from_page == from_page).tuples()}
+            added = new_links - old_links
+            removed = old_links - new_links if erase else set()
+            if added:
+                cls.insert_many([(from_page.id, i) for i in added],
+                    fields=[cls.from_page, cls.to_page]).execute()
+            for chunk in _chunks(removed, 500):
+                cls.delete().where((cls.from_page == from_page) & (cls.to_page.in_(chunk))).execute()
+            if not erase:
+                new_links |= old_links
+            PageWantedLink.set_wanted(from_page, wanted)
+            PageScore.refresh({from_page.id} | added | removed)
+        link_graph.set_links(from_page.id, new_links, wanted)
+        response_cache.invalidate_links_to(added | removed)
+
+    @classmethod
+    def resolve_wanted(cls, page):
+        '''
+        Turn wanted links to the URL of a new (or moved) page into links.
+        '''
+        wanted_urls = ['p/{0}'.format(page.id)] + ([page.url] if page.url else [])
+        with database.atomic():
+            from_ids = {i for i, in PageWantedLink.select(PageWantedLink.from_page)
+                .where(PageWantedLink.url.in_(wanted_urls)).tuples()}
+            if not from_ids:
+                return
+            from_ids -= {i for i, in cls.select(cls.from_page)
+                .where((cls.to_page == page) & (cls.from_page.in_(list(from_ids)))).tuples()}
+            if from_ids:
+                cls.insert_many([(i, page.id) for i in from_ids],
+                    fields=[cls.from_page, cls.to_page]).execute()
+            PageWantedLink.delete().where(PageWantedLink.url.in_(wanted_urls)).execute()
+            PageScore.refresh(from_ids | {page.id})
+        link_graph.invalidate()
+        response_cache.invalidate_links_to([page.id])
 
     # The actual ULTIMATE method to refresh all links
     # To be called from a maintenance script only!
     @classmethod
-    def refresh_all_links(cls):
-        for p in Page.select():
-            cls.parse_links(p, p.latest.text)
+    def refresh_all_links(cls, *, workers=None, chunk_size=200):
+        '''
+        Rebuild the whole link graph from the latest text of each page.
+
+        Texts are read in chunks, and links are extracted by a pool of
+        worker processes (none if workers is 1).
+        '''
+        url_to_id = {url: i for i, url in Page.select(Page.id, Page.url).where(Page.url.is_null(False)).tuples()}
+        all_ids = set(url_to_id.values())
+        all_ids.update(i for i, in Page.select(Page.id).where(Page.url.is_null()).tuples())
+        workers = workers or os.cpu_count() or 1
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers)
+            extract = partial(pool.map, extract_link_targets, chunksize=16)
+        else:
+            pool = None
+            extract = partial(map, extract_link_targets)
+        n = 0
+        try:
+            with database.atomic():
+                cls.delete().execute()
+                PageWantedLink.delete().execute()
+                for pages in _chunks(Page.select(Page.id, Page.latest_revision).order_by(Page.id).iterator(), chunk_size):
+                    texts = _latest_texts(pages)
+                    links, wanted = [], []
+                    for p, (urls, ids) in zip(pages, extract([texts.get(p.id, '') for p in pages])):
+                        targets = {url_to_id[u] for u in urls if u in url_to_id}
+                        targets.update(ids & all_ids)
+                        links.extend((p.id, t) for t in targets)
+                        wanted.extend((p.id, u) for u in urls if u not in url_to_id)
+                        wanted.extend((p.id, 'p/{0}'.format(i)) for i in ids - all_ids)
+                    for chunk in _chunks(links, 500):
+                        cls.insert_many(chunk, fields=[cls.from_page, cls.to_page]).execute()
+                    for chunk in _chunks(wanted, 500):
+                        PageWantedLink.insert_many(chunk, fields=[PageWantedLink.from_page, PageWantedLink.url]).execute()
+                    n += len(pages)
+                PageScore.refresh_all()
+        finally:
+            if pool:
+                pool.shutdown()
+        link_graph.invalidate()
+        return n
+
+# Links to pages which do not exist (yet).
+class PageWantedLink(BaseModel):
+    from_page = FK(Page, backref='wanted_links')
+    # as written in the link, e.g. "some-page" or "p/123"
+    url = CharField(256, index=True)
+
+    class Meta:
+        indexes = (
+            (('from_page', 'url'), True),
+        )
+
+    @classmethod
+    def set_wanted(cls, from_page, urls):
+        old_urls = {u for u, in cls.select(cls.url).where(cls.from_page == from_page).tuples()}
+        if urls - old_urls:
+            cls.insert_many([(from_page.id, u) for u in urls - old_urls],
+                fields=[cls.from_page, cls.url]).execute()
+        for chunk in _chunks(old_urls - urls, 500):
+            cls.delete().where((cls.from_page == from_page) & (cls.url.in_(chunk))).execute()
+
+def extract_link_targets(text):
+    '''
+    Return the URLs and ids of the pages linked from text.
+    '''
+    urls, ids = set(), set()
+    for mo in re.finditer(ILINK_RE, text):
+        pageurl = mo.group(1)
+        if pageurl.startswith('p/'):
+            ids.add(int(pageurl[2:]))
+        else:
+            urls.add(pageurl)
+    return urls, ids
+
+def _latest_texts(pages):
+    '''
+    Read the latest text of many pages in one query. Return a dict by page id.
+    '''
+    rev_ids = [p.latest_revision_id for p in pages if p.latest_revision_id]
+    texts = {}
+    for rev in (PageRevision.select(PageRevision.id, PageRevision.page, PageText)
+            .join(PageText).where(PageRevision.id.in_(rev_ids))):
+        texts[rev.page_id] = rev.textref.get_content()
+    for p in pages:
+        if p.id not in texts and not p.latest_revision_id:
+            # pointer not backfilled yet
+            latest = Page[p.id].latest
+            if latest:
+                texts[p.id] = latest.text
+    return texts
+
+class LinkGraph(object):
+    '''
+    In-memory copy of the link graph, as arrays of page ids.
+
+    It is loaded from PageLink when first needed, updated when links of a
+    page change, and loaded again after [graph]ttl seconds (default 300),
+    to see changes made by other processes.
+    '''
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self.forward = {}
+        self.backward = {}
+        self.wanted = {}
+        # last PageRank scores, see importance()
+        self._importance = None
+        self._importance_at = None
+        self._importance_stale = False
+        self._importance_running = False
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        ttl = _getconf('graph', 'ttl', 300, cast=int)
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < ttl:
+                return
+            forward = {i: [] for i, in Page.select(Page.id).tuples()}
+            backward = {i: [] for i in forward}
+            for from_id, to_id in PageLink.select(PageLink.from_page, PageLink.to_page).tuples():
+                # skip links of pages created, or left by pages deleted,
+                # after the page ids were read
+                if from_id in forward and to_id in backward:
+                    forward[from_id].append(to_id)
+                    backward[to_id].append(from_id)
+            wanted = {}
+            for from_id, url in PageWantedLink.select(PageWantedLink.from_page, PageWantedLink.url).tuples():
+                if from_id in forward:
+                    wanted.setdefault(url, []).append(from_id)
+            self.forward = {k: array('l', sorted(v)) for k, v in forward.items()}
+            self.backward = {k: array('l', sorted(v)) for k, v in backward.items()}
+            self.wanted = {k: array('l', sorted(v)) for k, v in wanted.items()}
+            self._importance_stale = True
+            self._loaded_at = time.monotonic()
+
+    def set_links(self, page_id, targets, wanted_urls=()):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            old = set(self.forward.get(page_id, ()))
+            targets = set(targets)
+            for t in old - targets:
+                self.backward[t] = array('l', (i for i in self.backward[t] if i != page_id))
+            for t in targets - old:
+                self.backward[t] = array('l', sorted(set(self.backward.get(t, ())) | {page_id}))
+            self.forward[page_id] = array('l', sorted(targets))
+            self.backward.setdefault(page_id, array('l'))
+            for url in list(self.wanted):
+                if page_id in self.wanted[url] and url not in wanted_urls:
+                    self.wanted[url] = array('l', (i for i in self.wanted[url] if i != page_id))
+                    if not self.wanted[url]:
+                        del self.wanted[url]
+            for url in wanted_urls:
+                if page_id not in self.wanted.get(url, ()):
+                    self.wanted[url] = array('l', sorted(set(self.wanted.get(url, ())) | {page_id}))
+            self._importance_stale = True
+
+    def orphans(self):
+        '''
+        Ids of pages no other page links to, newest first.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            return sorted((i for i, bl in self.backward.items() if not any(j != i for j in bl)), reverse=True)
+
+    def wanted_links(self):
+        '''
+        List of (url, ids of linking pages), most wanted first.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(self.wanted.items(), key=lambda x: (-len(x[1]), x[0]))
+
+    def backlink_counts(self, ids):
+        '''
+        Number of pages linking to each of ids, as a dict.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            return {i: len(self.backward.get(i, ())) for i in ids}
+
+    def importance(self, damping=0.85, iterations=50, tolerance=1e-9):
+        '''
+        Rank pages by how much they are linked from important pages
+        (PageRank). Return a dict of scores by page id, summing to 1.
+
+        Scores are computed on first use. After links change, they are
+        computed again in a background thread, at most every [graph]ttl
+        seconds, and the last scores are returned meanwhile.
+        '''
+        self._ensure_loaded()
+        ttl = _getconf('graph', 'ttl', 300, cast=int)
+        with self._lock:
+            if self._importance is not None:
+                if (self._importance_stale and not self._importance_running
+                        and time.monotonic() - self._importance_at >= ttl):
+                    self._importance_running = True
+                    threading.Thread(target=self._refresh_importance,
+                        args=(damping, iterations, tolerance), daemon=True).start()
+                return self._importance
+        return self._refresh_importance(damping, iterations, tolerance)
+
+    def _refresh_importance(self, damping, iterations, tolerance):
+        with self._lock:
+            # links changed from now on make the result stale again
+            self._importance_stale = False
+            # set_links() replaces arrays instead of changing them,
+            # so copies of the dicts are a snapshot
+            forward, backward = dict(self.forward), dict(self.backward)
+        try:
+            result = _pagerank(forward, backward, damping, iterations, tolerance)
+            with self._lock:
+                self._importance = result
+                self._importance_at = time.monotonic()
+            return result
+        finally:
+            with self._lock:
+                self._importance_running = False
+
+def _pagerank(forward, backward, damping, iterations, tolerance):
+    ids = list(forward)
+    n = len(ids)
+    if n == 0:
+        return {}
+    index = {i: k for k, i in enumerate(ids)}
+    out_degree = [len(forward[i]) for i in ids]
+    incoming = [[index[j] for j in backward.get(i, ()) if j in index] for i in ids]
+    rank = [1.0 / n] * n
+    for _ in range(iterations):
+        contrib = [r / d if d else 0.0 for r, d in zip(rank, out_degree)]
+        # pages without links spread their rank over all pages
+        base = (1.0 - damping) / n + damping * sum(r for r, d in zip(rank, out_degree) if not d) / n
+        new_rank = [base + damping * sum(contrib[j] for j in inc) for inc in incoming]
+        delta = sum(abs(a - b) for a, b in zip(rank, new_rank))
+        rank = new_rank
+        if delta < tolerance:
+            break
+    return dict(zip(ids, rank))
+
+link_graph = LinkGraph()
+
+# Leaderboard scores, updated along with links and revisions.
+class PageScore(BaseModel):
+    page = FK(Page, primary_key=True, backref='+')
+    length = IntegerField(default=0)
+    forward_links = IntegerField(default=0)
+    back_links = IntegerField(default=0)
+    score = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('score', 'back_links', 'length', 'forward_links'), False),
+        )
+
+    @classmethod
+    def refresh(cls, page_ids):
+        page_ids = list(set(page_ids))
+        for i in range(0, len(page_ids), 500):
+            cls._refresh_chunk(page_ids[i:i+500])
+
+    @classmethod
+    def _refresh_chunk(cls, page_ids):
+        if not page_ids:
+            return
+        fwd = dict(PageLink
+            .select(PageLink.from_page, fn.Count(PageLink.id))
+            .where(PageLink.from_page.in_(page_ids))
+            .group_by(PageLink.from_page).tuples())
+        back = dict(PageLink
+            .select(PageLink.to_page, fn.Count(PageLink.id))
+            .where(PageLink.to_page.in_(page_ids))
+            .group_by(PageLink.to_page).tuples())
+        lengths = dict(Page
+            .select(Page.id, PageRevision.length)
+            .join(PageRevision, on=(Page.latest_revision == PageRevision.id))
+            .where(Page.id.in_(page_ids)).tuples())
+        rows = []
+        for pid in page_ids:
+            length, f, b = lengths.get(pid, 0), fwd.get(pid, 0), back.get(pid, 0)
+            rows.append(dict(
+                page=pid,
+                length=length,
+                forward_links=f,
+                back_links=b,
+                score=(length >> 10) + f + b
+            ))
+        cls.replace_many(rows).execute()
+
+    # To be called from a maintenance script only!
+    @classmethod
+    def refresh_all(cls):
+        with database.atomic():
+            cls.refresh([p.id for p in Page.select(Page.id)])
 
 class PagePermission(BaseModel):
     page = ForeignKeyField(Page, backref='permission_overrides')
@@ -508,12 +1513,23 @@ class PagePermission(BaseModel):
             (('page', 'group'), True),
         )
 
+class LongTextField(TextField):
+    field_type = 'LONGTEXT'
+
+# Search index for MySQL. SQLite uses a FTS5 virtual table instead.
+class PageSearch(BaseModel):
+    page = FK(Page, primary_key=True, backref='+')
+    title = CharField(256)
+    tags = CharField(2048, default='')
+    text = LongTextField(default='')
+
 def init_db():
     database.create_tables([
         User, UserGroup, UserGroupMembership,
         Page, PageText, PageRevision, PageTag, PageProperty, PageLink,
-        PagePermission
+        PagePermission, PageRender, PageScore, PageWantedLink, TagStat, PageDiff
     ])
+    search_index.create_table()
 
 def init_db_and_create_first_user():
     try:
@@ -555,10 +1571,70 @@ def init_db_and_create_first_user():
             user = ua,
             group = ug
         )
+    invalidate_group_perms()
     print('Installed successfully!')
 
 #### PERMS HELPERS ####
 
+def _request_cache(name):
+    '''
+    A dict living as long as the current request (or app context).
+    '''
+    if not has_app_context():
+        return {}
+    caches = g.setdefault('_caches', {})
+    return caches.setdefault(name, {})
+
+# user id (0 for anonymous) -> (expiry time, group ids, permissions)
+_group_perms_cache = {}
+
+def get_group_perms(user):
+    '''
+    Return the ids of the groups of user, and the permissions they grant.
+    Pass None for anonymous users, who get the default group.
+
+    Groups rarely change, so results are shared between requests for
+    [permissions]cache_ttl seconds (default 300), or until
+    invalidate_group_perms() is called.
+    '''
+    user_id = user.id if user is not None else 0
+    cache = _request_cache('group_perms')
+    if user_id in cache:
+        return cache[user_id]
+    now = datetime.datetime.now().timestamp()
+    cached = _group_perms_cache.get(user_id)
+    if cached and cached[0] > now:
+        res = cached[1:]
+    else:
+        if user is None:
+            default_group = UserGroup.get_default_group()
+            res = frozenset((default_group.id,)), default_group.permissions
+        else:
+            group_ids, perm = set(), 0
+            for group_id, group_perm in (UserGroup.select(UserGroup.id, UserGroup.permissions)
+                    .join(UserGroupMembership, on=UserGroupMembership.group)
+                    .where(UserGroupMembership.user == user_id).tuples()):
+                group_ids.add(group_id)
+                perm |= group_perm
+            res = frozenset(group_ids), perm
+        ttl = _getconf('permissions', 'cache_ttl', 300, cast=int)
+        _group_perms_cache[user_id] = (now + ttl,) + res
+    cache[user_id] = res
+    return res
+
+def invalidate_group_perms(user_id=None):
+    '''
+    Forget cached permissions of a user, or of everyone if no user is given.
+    To be called after changing groups or memberships.
+    '''
+    if user_id is None:
+        _group_perms_cache.clear()
+        _request_cache('group_perms').clear()
+    else:
+        _group_perms_cache.pop(user_id, None)
+        _request_cache('group_perms').pop(user_id, None)
+    _request_cache('page_perms').clear()
+
 def has_perms(user, flags, page=None):
     if page:
         perm = page.get_perms(user)
@@ -571,20 +1647,58 @@ def has_perms(user, flags, page=None):
 
 #### WIKI SYNTAX ####
 
-def md_and_toc(text, toc=True):
+# Bump this whenever the output of the custom extensions changes,
+# so that cached HTML gets rendered again.
+MARKDOWN_RENDER_REVISION = 1
+
+def _markdown_extensions(toc=True):
     extensions = ['tables', 'footnotes', 'fenced_code', 'sane_lists']
-    extension_configs = {}
-    if not _getconf('markdown', 'disable_custom_extensions'): 
+    if not _getconf('markdown', 'disable_custom_extensions'):
         extensions.append(StrikethroughExtension())
         extensions.append(SpoilerExtension())
     if toc:
         extensions.append('toc')
+    return extensions
+
+@lru_cache(maxsize=None)
+def markdown_version_stamp():
+    '''
+    Identify the current Markdown configuration. Rendered HTML stored
+    with a different stamp is stale.
+    '''
+    names = [x if isinstance(x, str) else x.__class__.__name__ for x in _markdown_extensions()]
+    key = '{0};{1};{2}'.format(MARKDOWN_RENDER_REVISION, markdown.__version__, ','.join(names))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+# Configured converters, one for each thread and toc setting.
+# Building one costs about as much as converting a short text, and
+# little next to a long one (see python3 -m app_bench markdown).
+_md_converters = threading.local()
+
+def _get_converter(toc=True):
     try:
-        converter = markdown.Markdown(extensions=extensions, extension_configs=extension_configs)
-        if toc:
-            return converter.convert(text), converter.toc
-        else:
-            return converter.convert(text), ''
+        pool = _md_converters.pool
+    except AttributeError:
+        pool = _md_converters.pool = {}
+    if toc not in pool:
+        pool[toc] = markdown.Markdown(extensions=_markdown_extensions(toc))
+    return pool[toc]
+
+def render_markdown(text, toc=True):
+    '''
+    Like md_and_toc(), but let rendering errors propagate.
+    '''
+    converter = _get_converter(toc)
+    try:
+        with perf_phase('md'):
+            html = converter.convert(text)
+        return html, (converter.toc if toc else '')
+    finally:
+        converter.reset()
+
+def md_and_toc(text, toc=True):
+    try:
+        return render_markdown(text, toc=toc)
     except Exception as e:
         return '<p class="error">There was an error during rendering: {e.__class__.__name__}: {e}</p>'.format(e=e), ''
 
@@ -598,9 +1712,406 @@ def remove_tags(text, convert=True, headings=True):
         text = md(text, toc=False)
     return re.sub(r'<.*?>', '', text)
 
+def make_excerpt(text, length=200):
+    text = remove_tags(text, convert = not _getconf('appearance', 'simple_remove_tags', False))
+    return text[:length] + ('\u2026' if len(text) > length else '')
+
 def is_username(s):
     return re.match('^' + USERNAME_RE + '$', s)
 
+#### SEARCH ####
+
+class SearchResults(object):
+    '''
+    Lazy search results, paginated like a query.
+    '''
+    model = None
+    def __init__(self, index, q, include_tags=True):
+        self.index = index
+        self.q = q
+        self.include_tags = include_tags
+    def count(self):
+        return self.index.count(self.q, self.include_tags)
+    def paginate(self, page, paginate_by=20):
+        hits = self.index.fetch(self.q, self.include_tags,
+            limit=paginate_by, offset=(page - 1) * paginate_by)
+        by_id = {p.id: p for p in Page.prefetch_listing(
+            Page.select().where(Page.id.in_([x[0] for x in hits])))}
+        results = []
+        for pid, snippet in hits:
+            if pid in by_id:
+                p = by_id[pid]
+                if snippet:
+                    p.search_snippet = _mark_snippet(snippet)
+                results.append(p)
+        return results
+
+def _search_terms(q):
+    return re.findall(r'\w+', q.lower())
+
+def _search_snippet(text, terms, width=160):
+    '''
+    Cut an excerpt of text around the first term found, enclosing
+    terms in \x02 and \x03.
+    '''
+    if not terms:
+        return None
+    term_re = re.compile('|'.join(re.escape(t) for t in terms), re.I)
+    mo = term_re.search(text)
+    start = max(0, mo.start() - width // 2) if mo else 0
+    snippet = text[start:start + width]
+    snippet = term_re.sub(lambda m: '\x02' + m.group(0) + '\x03', snippet)
+    return ('\u2026' if start > 0 else '') + snippet + ('\u2026' if start + width < len(text) else '')
+
+def _mark_snippet(snippet):
+    return Markup(html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def _search_plain_text(text):
+    return remove_tags(text, convert=False, headings=False)
+
+class SearchIndex(object):
+    '''
+    Search over page titles and tags (and text, in subclasses).
+
+    This base class is used for databases without full text support,
+    and keeps no index.
+    '''
+    def create_table(self):
+        pass
+    def update_page(self, page, *, text=None, tags=None):
+        pass
+    def rebuild(self):
+        return 0
+    def search(self, q, include_tags=True):
+        return SearchResults(self, q, include_tags)
+    def _query(self, q, include_tags):
+        query = Page.select(Page.id).where(Page.title ** ('%' + q + '%'))
+        if include_tags:
+            query |= Page.select(Page.id).join(PageTag, on=PageTag.page
+                ).where(PageTag.name ** ('%' + q + '%'))
+        return query
+    def count(self, q, include_tags):
+        return self._query(q, include_tags).count()
+    def fetch(self, q, include_tags, limit, offset):
+        ids = [x.id for x in self._query(q, include_tags).order_by(Page.id.desc()).limit(limit).offset(offset)]
+        return [(i, None) for i in ids]
+
+class SqliteSearchIndex(SearchIndex):
+    '''
+    Search index backed by a FTS5 virtual table. Rows are keyed by page id.
+    '''
+    def create_table(self):
+        database.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS pagesearch '
+            'USING fts5(title, tags, text, tokenize="unicode61 remove_diacritics 2")')
+    def update_page(self, page, *, text=None, tags=None):
+        tags = ' '.join(tags if tags is not None else [x.name for x in page.tags])
+        if text is None:
+            database.execute_sql('UPDATE pagesearch SET title = ?, tags = ? WHERE rowid = ?',
+                (page.title, tags, page.id))
+        else:
+            database.execute_sql('DELETE FROM pagesearch WHERE rowid = ?', (page.id,))
+            database.execute_sql('INSERT INTO pagesearch (rowid, title, tags, text) VALUES (?, ?, ?, ?)',
+                (page.id, page.title, tags, _search_plain_text(text)))
+    def rebuild(self):
+        n = 0
+        with database.atomic():
+            database.execute_sql('DELETE FROM pagesearch')
+            for p in Page.select().where(Page.latest_revision.is_null(False)).iterator():
+                self.update_page(p, text=p.latest.text)
+                n += 1
+        return n
+    def _match(self, q, include_tags):
+        terms = _search_terms(q)
+        if not terms:
+            return None
+        expr = ' '.join('"{0}"*'.format(t.replace('"', '""')) for t in terms)
+        if not include_tags:
+            expr = '{title text} : (' + expr + ')'
+        return expr
+    def count(self, q, include_tags):
+        expr = self._match(q, include_tags)
+        if expr is None:
+            return 0
+        return database.execute_sql('SELECT COUNT(*) FROM pagesearch WHERE pagesearch MATCH ?',
+            (expr,)).fetchone()[0]
+    def fetch(self, q, include_tags, limit, offset):
+        expr = self._match(q, include_tags)
+        if expr is None:
+            return []
+        # title matches weigh most, then tags, then text
+        cur = database.execute_sql('SELECT rowid, snippet(pagesearch, 2, char(2), char(3), ?, 24) '
+            'FROM pagesearch WHERE pagesearch MATCH ? '
+            'ORDER BY bm25(pagesearch, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?',
+            ('\u2026', expr, limit, offset))
+        return [(pid, snippet or None) for pid, snippet in cur.fetchall()]
+
+class MySQLSearchIndex(SearchIndex):
+    '''
+    Search index backed by FULLTEXT indexes on the PageSearch table.
+    '''
+    def create_table(self):
+        database.create_tables([PageSearch])
+        for name, columns in (
+            ('pagesearch_fulltext', 'title, tags, text'),
+            ('pagesearch_fulltext_notags', 'title, text')
+        ):
+            try:
+                database.execute_sql('CREATE FULLTEXT INDEX {0} ON pagesearch ({1})'.format(name, columns))
+            except OperationalError:
+                # index already exists
+                pass
+    def update_page(self, page, *, text=None, tags=None):
+        tags = ' '.join(tags if tags is not None else [x.name for x in page.tags])
+        if text is None:
+            PageSearch.update(title=page.title, tags=tags).where(PageSearch.page == page.id).execute()
+        else:
+            PageSearch.replace(page=page.id, title=page.title, tags=tags,
+                text=_search_plain_text(text)).execute()
+    def rebuild(self):
+        n = 0
+        with database.atomic():
+            PageSearch.delete().execute()
+            for p in Page.select().where(Page.latest_revision.is_null(False)).iterator():
+                self.update_page(p, text=p.latest.text)
+                n += 1
+        return n
+    def _match(self, q, include_tags):
+        columns = 'title, tags, text' if include_tags else 'title, text'
+        return SQL('MATCH({0}) AGAINST (%s IN NATURAL LANGUAGE MODE)'.format(columns), (q,))
+    def count(self, q, include_tags):
+        return PageSearch.select().where(self._match(q, include_tags)).count()
+    def fetch(self, q, include_tags, limit, offset):
+        score = self._match(q, include_tags)
+        query = (PageSearch.select(PageSearch.page, PageSearch.text)
+            .where(score).order_by(score.desc()).limit(limit).offset(offset))
+        terms = _search_terms(q)
+        return [(x.page_id, _search_snippet(x.text, terms)) for x in query]
+
+if isinstance(database, SqliteDatabase):
+    search_index = SqliteSearchIndex()
+elif isinstance(database, MySQLDatabase):
+    search_index = MySQLSearchIndex()
+else:
+    search_index = SearchIndex()
+
+#### RESPONSE CACHE ####
+
+class ResponseCache(object):
+    '''
+    Cache of whole responses for anonymous readers. Disabled by default,
+    set [cache]backend to memory or filesystem to enable it.
+
+    Each entry depends on keys such as "page:1", "tag:foo", "pages" (any
+    page) or "links-to:1" (links to page 1, and titles of linking pages). Every key has a generation, which invalidate() changes: entries
+    stored with an older generation are not used anymore.
+    '''
+    enabled = False
+    def get(self, key):
+        return None
+    def set(self, key, value):
+        pass
+    def delete(self, key):
+        pass
+    def generation(self, dep):
+        return None
+    def bump(self, dep):
+        pass
+    def invalidate(self, page_id=None, tags=()):
+        if not self.enabled:
+            return
+        self.bump('pages')
+        if page_id is not None:
+            self.bump('page:{0}'.format(page_id))
+        for tag in tags:
+            self.bump('tag:{0}'.format(tag))
+    def invalidate_links_to(self, page_ids):
+        if not self.enabled:
+            return
+        for i in page_ids:
+            self.bump('links-to:{0}'.format(i))
+
+class MemoryResponseCache(ResponseCache):
+    '''
+    LRU cache in the memory of this process.
+    '''
+    enabled = True
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    def generation(self, dep):
+        return self._generations.get(dep, 0)
+    def bump(self, dep):
+        with self._lock:
+            self._generations[dep] = self._generations.get(dep, 0) + 1
+
+class FileResponseCache(ResponseCache):
+    '''
+    Cache in a directory, which can be shared by many worker processes.
+    When there are more than max_items entries, the least recently used
+    ones are removed.
+    '''
+    enabled = True
+    # check the number of entries every this many writes
+    sweep_interval = 100
+    def __init__(self, path, max_items=1000):
+        self.path = path
+        self.max_items = max_items
+        self._writes = 0
+        os.makedirs(os.path.join(path, 'gen'), exist_ok=True)
+    def _file(self, *parts):
+        return os.path.join(self.path, *parts[:-1], hashlib.sha1(parts[-1].encode('utf-8')).hexdigest())
+    def _write(self, filename, data):
+        tmp = '{0}.{1}.tmp'.format(filename, os.urandom(4).hex())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+    def get(self, key):
+        filename = self._file(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = pickle.load(f)
+            # modification time tells which entries were used last
+            os.utime(filename)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+    def set(self, key, value):
+        self._write(self._file(key), pickle.dumps(value))
+        self._writes += 1
+        if self._writes % self.sweep_interval == 1:
+            self.sweep()
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+    def sweep(self):
+        '''
+        Remove the least recently used entries beyond max_items.
+        '''
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file():
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+        if len(entries) <= self.max_items:
+            return
+        entries.sort()
+        for _, filename in entries[:len(entries) - self.max_items]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+    def generation(self, dep):
+        try:
+            with open(self._file('gen', dep), 'rb') as f:
+                return f.read()
+        except OSError:
+            return b''
+    def bump(self, dep):
+        self._write(self._file('gen', dep), os.urandom(8))
+
+def _make_response_cache():
+    backend = _getconf('cache', 'backend', 'none')
+    if backend == 'memory':
+        return MemoryResponseCache(max_items=_getconf('cache', 'max_items', 1000, cast=int))
+    elif backend == 'filesystem':
+        return FileResponseCache(_getconf('cache', 'path', os.path.join(APP_BASE_DIR, 'cache')),
+            max_items=_getconf('cache', 'max_items', 1000, cast=int))
+    return ResponseCache()
+
+response_cache = _make_response_cache()
+
+def cache_depends(*deps):
+    '''
+    Declare what the current view depends on, e.g. cache_depends('page:1').
+    '''
+    if g.get('cache_deps') is not None:
+        for dep in deps:
+            g.cache_deps.setdefault(dep, response_cache.generation(dep))
+
+def cache_expires(when):
+    '''
+    Declare that the current view is valid only until when (a datetime).
+    '''
+    if g.get('cache_deps') is not None:
+        g.cache_expires = min(g.get('cache_expires') or when.timestamp(), when.timestamp())
+
+# locales with a translation; others are shown in English
+_cache_locales = {name.split('.')[1] for name in os.listdir(os.path.join(APP_BASE_DIR, 'i18n'))
+    if name.startswith('salvi.') and name.endswith('.json')}
+
+def _response_cache_key(query_args):
+    '''
+    Cache key of the current request, or None if it has query arguments
+    which the view does not use, so that they cannot fill the cache.
+    '''
+    if any(k not in query_args and k != 'uselang' for k in request.args):
+        return None
+    query = urlencode([(k, request.args[k]) for k in sorted(query_args) if k in request.args])
+    return '{0}?{1}|{2}|{3}'.format(request.path, query,
+        g.lang if g.lang in _cache_locales else 'en', request.cookies.get('dark') == '1')
+
+def cached_view(f=None, *, args=()):
+    '''
+    Serve anonymous GET requests of the view from the response cache.
+    Views only get cached if they call cache_depends(). args are the
+    query arguments the view reads; requests with others are not cached.
+    '''
+    if f is None:
+        return partial(cached_view, args=args)
+    @wraps(f)
+    def wrapper(*a, **kwargs):
+        if (not response_cache.enabled or request.method != 'GET' or
+                current_user.is_authenticated or '_flashes' in session):
+            return f(*a, **kwargs)
+        key = _response_cache_key(args)
+        if key is None:
+            return f(*a, **kwargs)
+        entry = response_cache.get(key)
+        if entry is not None:
+            deps, expires, status, headers, body = entry
+            if expires > time.time() and all(response_cache.generation(k) == v for k, v in deps.items()):
+                resp = Response(body, status=status, headers=headers)
+                if resp.headers.get('ETag') and request.if_none_match.contains_weak(resp.get_etag()[0]):
+                    resp = Response(status=304, headers=headers)
+                resp.headers['X-Cache'] = 'HIT'
+                return resp
+            # expired or stale entries are never used again
+            response_cache.delete(key)
+        g.cache_deps = {}
+        g.cache_expires = None
+        resp = make_response(f(*a, **kwargs))
+        if resp.status_code == 200 and g.cache_deps and '_flashes' not in session:
+            headers = [(k, v) for k, v in resp.headers.items() if k.lower() != 'set-cookie']
+            expires = time.time() + _getconf('cache', 'ttl', 600, cast=int)
+            if g.cache_expires is not None:
+                expires = min(expires, g.cache_expires)
+            response_cache.set(key, (g.cache_deps, expires, resp.status_code, headers, resp.get_data()))
+        g.cache_deps = None
+        return resp
+    return wrapper
+
 #### I18N ####
 
 i18n.load_path.append(os.path.join(APP_BASE_DIR, 'i18n'))
@@ -637,6 +2148,137 @@ login_manager = LoginManager(app)
 
 login_manager.login_view = 'accounts_login'
 
+#### INSTRUMENTATION ####
+
+# Set [perf]enabled = 1 to time each request. Phases are:
+# sql (queries), md (Markdown), tpl (templates, including the queries and
+# Markdown run while rendering), text (decompression of page texts) and
+# pool or connect (checkout of the database connection).
+PERF_ENABLED = bool(_getconf('perf', 'enabled', 0, cast=int))
+
+# recent requests of each route, as (milliseconds, queries)
+_perf_stats = collections.defaultdict(partial(collections.deque, maxlen=1000))
+
+@contextmanager
+def perf_phase(name):
+    stats = g.get('_perf') if has_app_context() else None
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = stats.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+
+def perf_summary():
+    '''
+    Counts and times of the current request so far, as a string.
+    '''
+    stats = g.get('_perf')
+    if stats is None:
+        return ''
+    return ', '.join('{0}: {1} in {2:.1f} ms'.format(name, n, t * 1000)
+        for name, (n, t) in sorted(stats.items()))
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+if PERF_ENABLED:
+    _execute_sql = database.execute_sql
+
+    def _timed_execute_sql(*args, **kwargs):
+        with perf_phase('sql'):
+            return _execute_sql(*args, **kwargs)
+    database.execute_sql = _timed_execute_sql
+
+    @before_render_template.connect_via(app)
+    def _perf_before_template(sender, template, context, **extra):
+        g.setdefault('_perf_tpl_start', []).append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def _perf_after_template(sender, template, context, **extra):
+        starts = g.get('_perf_tpl_start')
+        if starts and g.get('_perf') is not None:
+            entry = g._perf.setdefault('tpl', [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - starts.pop()
+
+    @app.before_request
+    def _perf_start():
+        g._perf = {}
+        g._perf_start = time.perf_counter()
+
+    @app.after_request
+    def _perf_finish(resp):
+        stats = g.pop('_perf', None)
+        if stats is None:
+            return resp
+        total = time.perf_counter() - g._perf_start
+        resp.headers['Server-Timing'] = ', '.join(
+            ['{0};dur={1:.2f};desc="{2}x"'.format(name, t * 1000, n) for name, (n, t) in sorted(stats.items())] +
+            ['db-{0};desc="{1}/{2} in use, {3} idle"'.format(x['name'], x['in_use'], x['max_connections'], x['idle'])
+                for x in pool_stats() if x['pooled']] +
+            ['total;dur={0:.2f}'.format(total * 1000)])
+        _perf_stats[request.url_rule.rule if request.url_rule else '(none)'].append(
+            (total * 1000, stats.get('sql', (0,))[0]))
+        return resp
+
+#### CONNECTIONS ####
+
+# databases with a connection per request, by name
+managed_databases = {}
+
+# connection checkouts of each database, as [count, total wait, longest wait]
+_checkout_stats = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+def manage_connections(db, scope=app, name='main'):
+    '''
+    Check out a connection of db at the start of each request of scope (the
+    app, or a blueprint), and close it, or give it back to the pool, at the
+    end. Requests for static files do not use the database.
+    '''
+    managed_databases[name] = db
+
+    @scope.before_request
+    def _db_connect():
+        if request.endpoint == 'static':
+            return
+        start = time.perf_counter()
+        with perf_phase('pool' if isinstance(db, PooledDatabase) else 'connect'):
+            db.connect(reuse_if_open=True)
+        wait = time.perf_counter() - start
+        stats = _checkout_stats[name]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+    @scope.teardown_request
+    def _db_close(exc):
+        if not db.is_closed():
+            db.close()
+
+def pool_stats():
+    '''
+    State of each managed database: connections in use and idle for pools,
+    and checkout counts and waits (in milliseconds) for all.
+    '''
+    result = []
+    for name, db in managed_databases.items():
+        n, total, longest = _checkout_stats.get(name, (0, 0.0, 0.0))
+        entry = dict(name=name, backend=type(db).__name__, pooled=isinstance(db, PooledDatabase),
+            checkouts=n, avg_wait=total * 1000 / n if n else 0, max_wait=longest * 1000)
+        if entry['pooled']:
+            entry.update(in_use=len(db._in_use), idle=len(db._connections),
+                max_connections=db._max_connections)
+        result.append(entry)
+    return result
+
+manage_connections(database)
+
 #### ROUTES ####
 
 def _get_lang():
@@ -664,6 +2306,7 @@ def _inject_variables():
         'strong': lambda x:Markup('<strong>{0}</strong>').format(x),
         'app_version': __version__,
         'material_icons_url': _getconf('site', 'material_icons_url'),
+        'perf_summary': perf_summary,
         'min': min
     }
 
@@ -682,10 +2325,12 @@ def linebreaks(text):
 app.template_filter(name='markdown')(md)
 
 @app.route('/')
+@cached_view
 def homepage():
+    cache_depends('pages')
     page_limit = _getconf("appearance", "items_per_page", 20, cast=int)
-    return render_template('home.jinja2', new_notes=Page.select()
-        .order_by(Page.touched.desc()).limit(page_limit))
+    return render_template('home.jinja2', new_notes=Page.prefetch_listing(Page.select()
+        .order_by(Page.touched.desc()).limit(page_limit)))
 
 @app.route('/robots.txt')
 def robots():
@@ -782,15 +2427,9 @@ def create():
         except IntegrityError as e:
             flash('An error occurred while saving this revision: {e}'.format(e=e))
             return savepoint(request.form)
-        pr = PageRevision.create(
-            page=p,
-            user_id=p.owner.id,
-            comment='',
-            textref=PageText.create_content(request.form['text']),
-            pub_date=datetime.datetime.now(),
-            length=len(request.form['text'])
-        )
+        pr = p.add_revision(request.form['text'], user_id=p.owner.id)
         PageLink.parse_links(p, request.form['text'])
+        PageLink.resolve_wanted(p)
         return redirect(p.get_url())
     return savepoint({
         "url": request.args.get("url"),
@@ -826,6 +2465,8 @@ def edit(id):
         if any(not re.fullmatch(SLUG_RE, x) for x in p_tags):
             flash('Invalid tags text. Tags contain only letters, numbers and hyphens, and are separated by comma.')
             return savepoint(request.form, pageobj=p)
+        old_url = p.url
+        old_title = p.title
         p.url = p_url
         p.title = request.form['title']
         p.touched = datetime.datetime.now()
@@ -835,15 +2476,15 @@ def edit(id):
         p.save()
         p.change_tags(p_tags)
         if request.form['text'] != p.latest.text:
-            pr = PageRevision.create(
-                page=p,
+            pr = p.add_revision(request.form['text'],
                 user_id=current_user.id,
-                comment=request.form["comment"],
-                textref=PageText.create_content(request.form['text']),
-                pub_date=datetime.datetime.now(),
-                length=len(request.form['text'])
+                comment=request.form["comment"]
             )
             PageLink.parse_links(p, request.form['text'])
+        if p.url and p.url != old_url:
+            PageLink.resolve_wanted(p)
+        if p.title != old_title:
+            p.invalidate_link_targets()
         return redirect(p.get_url())
     
     form = {
@@ -870,6 +2511,7 @@ def __sync_start():
     return redirect("/")
 
 @app.route('/_jsoninfo/<int:id>', methods=['GET', 'POST'])
+@csrf.exempt
 def page_jsoninfo(id):
     try:
         p = Page[id]
@@ -881,17 +2523,86 @@ def page_jsoninfo(id):
         j["text"] = p.latest.text
     return jsonify(j)
 
+JSONINFO_CHANGED_LIMIT = 1000
+JSONINFO_BATCH_LIMIT = 200
+
+def _jsoninfo_limit(maximum):
+    try:
+        return max(1, min(int(request.values.get('limit', maximum)), maximum))
+    except ValueError:
+        return maximum
+
+def _jsoninfo_response(data):
+    resp = jsonify(data)
+    resp.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings and resp.content_length > 1024:
+        resp.set_data(gzip.compress(resp.get_data(), compresslevel=5))
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
 @app.route("/_jsoninfo/changed/<float:ts>")
 def jsoninfo_changed(ts):
-    tse = str(datetime.datetime.fromtimestamp(ts).isoformat(" "))
-    ps = Page.select().where(Page.touched >= tse)
+    ps = Page.select(Page.id, Page.touched).where(Page.touched >= datetime.datetime.fromtimestamp(ts))
+    try:
+        ps, next_cursor = keyset_paginate(ps, (Page.touched, Page.id),
+            cursor=request.args.get('cursor'), limit=_jsoninfo_limit(JSONINFO_CHANGED_LIMIT))
+    except ValueError:
+        return jsonify({'status': 'fail'}), 400
     return jsonify({
         "ids": [i.id for i in ps],
+        "next": next_cursor,
+        "status": "ok"
+    })
+
+@app.route('/_jsoninfo/batch')
+def jsoninfo_batch():
+    '''
+    Info and latest text of many pages, for replicas.
+
+    Pass either ids (comma separated), or since (a timestamp) and the
+    cursor given in the previous response. Add text=0 to leave out texts.
+    '''
+    limit = _jsoninfo_limit(JSONINFO_BATCH_LIMIT)
+    next_cursor = None
+    if request.values.get('ids'):
+        try:
+            ids = [int(x) for x in request.values['ids'].split(',')]
+        except ValueError:
+            return jsonify({'status': 'fail'}), 400
+        if len(ids) > limit:
+            return jsonify({'status': 'fail', 'message': 'too many ids'}), 400
+        pages = Page.prefetch_listing(Page.select().where(Page.id.in_(ids)).order_by(Page.id))
+    elif request.values.get('since'):
+        try:
+            since = datetime.datetime.fromtimestamp(float(request.values['since']))
+            keys, next_cursor = keyset_paginate(
+                Page.select(Page.id, Page.touched).where(Page.touched >= since),
+                (Page.touched, Page.id), cursor=request.values.get('cursor'), limit=limit)
+        except ValueError:
+            return jsonify({'status': 'fail'}), 400
+        pages = Page.prefetch_listing(Page.select().where(Page.id.in_([p.id for p in keys]))
+            .order_by(Page.touched, Page.id))
+    else:
+        return jsonify({'status': 'fail'}), 400
+    Page.prefetch_perms(pages)
+    if request.values.get('text', '1') != '0':
+        revs = [p.latest for p in pages if p.latest]
+        texts = {pt.id: pt for pt in PageText.select().where(
+            PageText.id.in_([rev.textref_id for rev in revs]))}
+        for rev in revs:
+            rev.textref = texts[rev.textref_id]
+        data = [dict(p.js_info(), text=p.latest.text if p.latest else None) for p in pages]
+    else:
+        data = [p.js_info() for p in pages]
+    return _jsoninfo_response({
+        "pages": data,
+        "next": next_cursor,
         "status": "ok"
     })
 
     
 @app.route('/p/<int:id>/')
+@cached_view
 def view_unnamed(id):
     try:
         p = Page[id]
@@ -902,22 +2613,27 @@ def view_unnamed(id):
             return redirect(p.get_url())
         else:
             flash('The URL of this page is a reserved URL. Please change it.')
-    return render_template('view.jinja2', p=p, rev=p.latest)
+    cache_depends('page:{0}'.format(p.id), *['tag:' + t.name for t in p.tags])
+    return _render_page_view(p)
 
 @app.route('/embed/<int:id>/')
+@cached_view
 def embed_view(id):
     try:
         p = Page[id]
     except Page.DoesNotExist:
         return "", 404
-    rev = p.latest
-    return "<h1>{0}</h1><div class=\"inner-content\">{1}</div>".format(
-        html.escape(p.title), rev.html())
+    cache_depends('page:{0}'.format(p.id))
+    return render_conditional(view_etag('embed', p.id, p.touched, p.latest_revision_id), p.touched,
+        lambda: "<h1>{0}</h1><div class=\"inner-content\">{1}</div>".format(
+            html.escape(p.title), p.latest.html()))
 
 @app.route('/p/most_recent/')
+@cached_view(args=('after', 'before'))
 def view_most_recent():
-    general_query = Page.select().order_by(Page.touched.desc())
-    return render_paginated_template('listrecent.jinja2', 'notes', notes=general_query)
+    cache_depends('pages')
+    general_query = Page.select()
+    return render_keyset_template('listrecent.jinja2', 'notes', (Page.touched, Page.id), notes=general_query)
 
 @app.route('/p/random/')
 def view_random():
@@ -938,21 +2654,83 @@ def page_leaderboard():
         'Cache-Control': 'max-age=180, stale-while-revalidate=1800'
     }
 
-    pages = []
-    for p in Page.select():
-        score = (p.latest.length >> 10) + p.forward_links.count() + p.back_links.count()
-        pages.append((p, score, p.back_links.count(), p.forward_links.count(), p.latest.length))
-    pages.sort(key = lambda x: (x[1], x[2], x[4], x[3]), reverse = True)
-        
-    return render_template('leaderboard.jinja2', pages=pages), headers
+    query = (PageScore.select(PageScore, Page)
+        .join(Page, on=PageScore.page)
+        .order_by(PageScore.score.desc(), PageScore.back_links.desc(),
+            PageScore.length.desc(), PageScore.forward_links.desc()))
+    return render_paginated_template('leaderboard.jinja2', 'pages', pages=query), headers
+
+def _paginate_ids(ids):
+    '''
+    Pick the current page of a list of ids. Return (pagination, ids).
+    '''
+    page_n = max(1, int(request.args.get('page', 1)))
+    per_page = _items_per_page()
+    items = ids[(page_n - 1) * per_page:page_n * per_page]
+    return Pagination(per_page, len(ids), page_n=page_n, n_items=len(items)), items
+
+@app.route('/p/orphans/')
+def page_orphans():
+    orphans = link_graph.orphans()
+    pagination, ids = _paginate_ids(orphans)
+    pages = Page.prefetch_listing(Page.select().where(Page.id.in_(ids)).order_by(Page.id.desc()))
+    return render_template('orphans.jinja2', pages=pages, pagination=pagination)
+
+@app.route('/p/wanted/')
+def page_wanted():
+    wanted = link_graph.wanted_links()
+    pagination, items = _paginate_ids(wanted)
+    titles = dict(Page.select(Page.id, Page.title)
+        .where(Page.id.in_([i for url, ids in items for i in ids[:5]])).tuples())
+    return render_template('wanted.jinja2', wanted=items, titles=titles, pagination=pagination)
+
+@app.route('/p/important/')
+def page_important():
+    ranks = link_graph.importance()
+    ranking = sorted(ranks, key=lambda i: (-ranks[i], i))
+    pagination, ids = _paginate_ids(ranking)
+    pages = {p.id: p for p in Page.select(Page.id, Page.url, Page.title).where(Page.id.in_(ids))}
+    backlinks = link_graph.backlink_counts(ids)
+    rows = [(pages[i], ranks[i] * len(ranks), backlinks[i]) for i in ids if i in pages]
+    return render_template('important.jinja2', rows=rows, pagination=pagination)
 
 @app.route('/<slug:name>/')
+@cached_view
 def view_named(name):
     try:
         p = Page.get(Page.url == name)
     except Page.DoesNotExist:
         abort(404)
-    return render_template('view.jinja2', p=p, rev=p.latest)
+    cache_depends('page:{0}'.format(p.id), *['tag:' + t.name for t in p.tags])
+    return _render_page_view(p)
+
+def _page_view_context(p):
+    '''
+    What view.jinja2 shows besides the page and its revision. It changes
+    along with other pages and permissions, so it goes into the ETag.
+    '''
+    # backlink titles are in the keywords
+    cache_depends('links-to:{0}'.format(p.id))
+    return dict(
+        tag_popularity = p.tag_popularity(),
+        seo_keywords = p.seo_keywords(),
+        is_editable = bool(p.is_editable())
+    )
+
+def _render_page_view(p):
+    rev = p.latest
+    context = _page_view_context(p)
+    etag_parts = ['view', p.id, p.touched, p.latest_revision_id, sorted(context.items())]
+    last_modified = p.touched
+    period = rev.human_pub_date_period() if rev else None
+    if period:
+        # the date is shown as "n minutes ago", which changes by itself
+        start, end = period
+        etag_parts.append(start)
+        last_modified = max(last_modified, start)
+        cache_expires(end)
+    return render_conditional(view_etag(*etag_parts), last_modified,
+        lambda: render_template('view.jinja2', p=p, rev=rev, **context))
 
 @app.route('/history/<int:id>/')
 def history(id):
@@ -960,7 +2738,21 @@ def history(id):
         p = Page[id]
     except Page.DoesNotExist:
         abort(404)
-    return render_template('history.jinja2', p=p, history=p.revisions.order_by(PageRevision.pub_date.desc()))
+    return render_keyset_template('history.jinja2', 'history', (PageRevision.pub_date, PageRevision.id),
+        count=False, p=p, history=PageRevision.select_metadata().where(PageRevision.page == p),
+        cached_diffs=_cached_diff_counts)
+
+def _cached_diff_counts(revs):
+    '''
+    Lines (added, removed) by each revision of a history listing (newest
+    first), if its diff with the previous one was already computed.
+    '''
+    revs = list(revs)
+    pairs = {(older.id, newer.id) for newer, older in zip(revs, revs[1:])}
+    return {new_id: (added, removed) for old_id, new_id, added, removed in PageDiff
+        .select(PageDiff.old, PageDiff.new, PageDiff.added, PageDiff.removed)
+        .where(PageDiff.new.in_([r.id for r in revs]) & (PageDiff.version == DIFF_FORMAT_VERSION))
+        .tuples() if (old_id, new_id) in pairs}
 
 @app.route('/u/<username>/')
 def contributions_legacy_url(username):
@@ -972,9 +2764,13 @@ def contributions(username):
         user = User.get(User.username == username)
     except User.DoesNotExist:
         abort(404)
-    contributions = user.contributions.order_by(PageRevision.pub_date.desc())
-    return render_paginated_template('contributions.jinja2',
-        "contributions",
+    contributions = (PageRevision
+        .select(PageRevision.id, PageRevision.page, PageRevision.comment, PageRevision.pub_date,
+            PageRevision.length, Page.id, Page.url, Page.title)
+        .join(Page, on=PageRevision.page)
+        .where(PageRevision.user == user))
+    return render_keyset_template('contributions.jinja2',
+        "contributions", (PageRevision.pub_date, PageRevision.id),
         u=user, 
         contributions=contributions,
     )
@@ -992,7 +2788,9 @@ def _advance_calendar(date, offset=0):
         return date
 
 @app.route('/calendar/')
+@cached_view(args=('from_year', 'till_year'))
 def calendar_view():
+    cache_depends('pages')
     now = datetime.datetime.now()
     return render_template('calendar.jinja2', now=now,
         from_year=int(request.args.get('from_year', now.year - 12)),
@@ -1000,7 +2798,9 @@ def calendar_view():
     )
 
 @app.route('/calendar/<int:y>/<int:m>')
+@cached_view
 def calendar_month(y, m):
+    cache_depends('pages')
     notes = Page.select().where(
         (datetime.date(y, m, 1) <= Page.calendar) &
         (Page.calendar < datetime.date(y+1 if m==12 else y, 1 if m==12 else m+1, 1))
@@ -1023,7 +2823,39 @@ def view_old(revisionid):
     except PageRevision.DoesNotExist:
         abort(404)
     p = rev.page
-    return render_template('viewold.jinja2', p=p, rev=rev)
+    # the revision never changes, but the page title and tags shown with it may
+    context = _page_view_context(p)
+    return render_conditional(view_etag('viewold', rev.id, p.touched, sorted(context.items())),
+        max(rev.pub_date, p.touched),
+        lambda: render_template('viewold.jinja2', p=p, rev=rev, **context),
+        cache_control='{0}, max-age=86400'.format('private' if current_user.is_authenticated else 'public'))
+
+@app.route('/history/diff/<int:b>/')
+def view_diff_previous(b):
+    try:
+        rev = PageRevision[b]
+    except PageRevision.DoesNotExist:
+        abort(404)
+    prev_id = rev.previous_id()
+    if prev_id is None:
+        # first revision
+        return redirect('/history/revision/{0}/'.format(rev.id))
+    return redirect('/history/diff/{0}/{1}/'.format(prev_id, rev.id))
+
+@app.route('/history/diff/<int:a>/<int:b>/')
+def view_diff(a, b):
+    try:
+        old, new = PageRevision[a], PageRevision[b]
+    except PageRevision.DoesNotExist:
+        abort(404)
+    if old.page_id != new.page_id:
+        abort(400)
+    p = new.page
+    def render():
+        diff = PageDiff.get_or_compute(old, new)
+        return render_template('diff.jinja2', p=p, old=old, new=new, diff=diff, rows=diff.get_rows())
+    return render_conditional(view_etag('diff', a, b, p.touched), max(old.pub_date, new.pub_date, p.touched),
+        render, cache_control='{0}, max-age=86400'.format('private' if current_user.is_authenticated else 'public'))
 
 @app.route('/backlinks/<int:id>/')
 def backlinks(id):
@@ -1036,21 +2868,45 @@ def backlinks(id):
 @app.route('/search/', methods=['GET', 'POST'])
 def search():
     if request.method == 'POST':
-        q = request.form['q']
-        include_tags = bool(request.form.get('include-tags'))
-        query = Page.select().where(Page.title ** ('%' + q + '%'))
-        if include_tags:
-            query |= Page.select().join(PageTag, on=PageTag.page
-                ).where(PageTag.name ** ('%' + q + '%'))
-        query = query.order_by(Page.touched.desc())
-        return render_template('search.jinja2', q=q, pl_include_tags=include_tags,
-            results=query.paginate(1))
+        # legacy form
+        return redirect('/search/?q={0}&include-tags={1}'.format(quote(request.form['q']),
+            '1' if request.form.get('include-tags') else ''))
+    q = request.args.get('q', '').strip()
+    if q:
+        include_tags = bool(request.args.get('include-tags'))
+        return render_paginated_template('search.jinja2', 'results', q=q,
+            pl_include_tags=include_tags,
+            results=search_index.search(q, include_tags=include_tags))
     return render_template('search.jinja2', pl_include_tags=True)
 
+@app.route('/tags/')
+@cached_view(args=('page',))
+def tag_index():
+    cache_depends('pages')
+    cloud = list(TagStat.select().order_by(TagStat.count.desc(), TagStat.name).limit(60))
+    if cloud:
+        low, high = math.log(cloud[-1].count), math.log(cloud[0].count)
+        for stat in cloud:
+            # font size classes 1 to 5
+            stat.size = 1 + round(4 * (math.log(stat.count) - low) / (high - low)) if high > low else 3
+        cloud.sort(key=lambda x: x.name)
+    return render_paginated_template('tags.jinja2', 'tags', cloud=cloud,
+        tags=TagStat.select().order_by(TagStat.count.desc(), TagStat.name))
+
+@app.route('/_jsoninfo/tags')
+def jsoninfo_tags():
+    q = request.args.get('q', '').strip().lower().lstrip('#')
+    return jsonify({
+        "tags": [dict(name=x.name, count=x.count) for x in TagStat.complete(q)] if q else [],
+        "status": "ok"
+    })
+
 @app.route('/tags/<slug:tag>/')
+@cached_view(args=('after', 'before'))
 def listtag(tag):
-    general_query = Page.select().join(PageTag, on=PageTag.page).where(PageTag.name == tag).order_by(Page.touched.desc())
-    return render_paginated_template('listtag.jinja2', "tagged_notes", tagname=tag, tagged_notes=general_query)
+    cache_depends('tag:' + tag)
+    general_query = Page.select().join(PageTag, on=PageTag.page).where(PageTag.name == tag)
+    return render_keyset_template('listtag.jinja2', "tagged_notes", (Page.touched, Page.id), tagname=tag, tagged_notes=general_query)
 
 
 # symbolic route as of v0.5
@@ -1130,6 +2986,8 @@ def accounts_register():
                     user = u,
                     group = UserGroup.get_default_group()
                 )
+            invalidate_group_perms(u.id)
+            _count_cache.clear()
             
             login_user(u)
             return redirect(request.args.get('next', '/'))
@@ -1194,12 +3052,47 @@ def easter_y(y=None):
 def manage_main():
     return render_template('administration.jinja2')
 
+@app.route('/manage/perf/')
+def manage_perf():
+    if not current_user.is_authenticated or not current_user.is_admin:
+        abort(403)
+    routes = []
+    for rule, samples in sorted(_perf_stats.items()):
+        samples = list(samples)
+        times = [x[0] for x in samples]
+        queries = [x[1] for x in samples]
+        routes.append(dict(rule=rule, n=len(samples),
+            p50=_percentile(times, 50), p95=_percentile(times, 95),
+            q50=_percentile(queries, 50), q95=_percentile(queries, 95), qmax=max(queries)))
+    return render_template('manageperf.jinja2', routes=routes, perf_enabled=PERF_ENABLED,
+        databases=pool_stats())
+
 ## import / export ##
 
 class Exporter(object):
-    def __init__(self):
-        self.root = {'pages': [], 'users': {}}
+    '''
+    Export pages as JSON (a single object, the classic format) or as
+    NDJSON (one record per line). Output is generated incrementally, so
+    that memory use does not grow with the size of the export.
+    '''
+    # revisions are read in batches of this size
+    batch_size = 50
+
+    def __init__(self, format='json'):
+        self.format = format
+        self.queries = []
+        self.user_ids = set()
     def add_page(self, p, include_history=True, include_users=False):
+        self.add_page_list([p], include_history=include_history, include_users=include_users)
+    def add_page_list(self, pl, include_history=True, include_users=False):
+        self.queries.append((pl, include_history, include_users))
+    def _iter_pages(self):
+        for pl, include_history, include_users in self.queries:
+            if hasattr(pl, 'iterator'):
+                pl = pl.iterator()
+            for p in pl:
+                yield p, include_history, include_users
+    def _page_info(self, p, include_users):
         pobj = {}
         pobj['title'] = p.title
         pobj['url'] = p.url
@@ -1208,78 +3101,254 @@ class Exporter(object):
         pobj['flags'] = p.flags
         if include_users:
             pobj['owner'] = p.owner_id
-        hist = []
-        for rev in (p.revisions if include_history else [p.latest]):
+        return pobj
+    def _iter_revisions(self, p, include_history, include_users):
+        base_query = (PageRevision.select(PageRevision, PageText)
+            .join(PageText, on=PageRevision.textref)
+            .where(PageRevision.page == p.id))
+        if not include_history:
+            revs = base_query.where(PageRevision.id == p.latest_revision_id)
+        else:
+            revs = self._iter_batches(base_query)
+        for rev in revs:
             revobj = {}
             revobj['text'] = rev.text
             revobj['timestamp'] = rev.pub_date.timestamp()
             if include_users:
                 revobj['user'] = rev.user_id
-                if rev.user_id not in self.root['users']:
-                    self.root['users'][rev.user_id] = rev.user_info()
+                self.user_ids.add(rev.user_id)
             else:
                 revobj['user'] = None
             revobj['comment'] = rev.comment
             revobj['length'] = rev.length
-            hist.append(revobj)
-        pobj['history'] = hist
-        self.root['pages'].append(pobj)
-    def add_page_list(self, pl, include_history=True, include_users=False):
-        for p in pl:
-            self.add_page(p, include_history=include_history, include_users=include_users)
+            yield revobj
+    def _iter_batches(self, query):
+        last_id = 0
+        while True:
+            batch = list(query.where(PageRevision.id > last_id)
+                .order_by(PageRevision.id).limit(self.batch_size))
+            yield from batch
+            if len(batch) < self.batch_size:
+                return
+            last_id = batch[-1].id
+    def _users_info(self):
+        return {
+            u.id: {'username': u.username}
+            for u in User.select(User.id, User.username).where(User.id.in_(list(self.user_ids)))
+        }
+    def iter_export(self):
+        if self.format == 'ndjson':
+            return self._iter_ndjson()
+        return self._iter_json()
+    def _iter_json(self):
+        yield '{"pages": ['
+        first = True
+        for p, include_history, include_users in self._iter_pages():
+            pobj = json.dumps(self._page_info(p, include_users))
+            yield ('' if first else ', ') + pobj[:-1] + ', "history": ['
+            first = False
+            first_rev = True
+            for revobj in self._iter_revisions(p, include_history, include_users):
+                yield ('' if first_rev else ', ') + json.dumps(revobj)
+                first_rev = False
+            yield ']}'
+        yield '], "users": ' + json.dumps(self._users_info()) + '}'
+    def _iter_ndjson(self):
+        for p, include_history, include_users in self._iter_pages():
+            pobj = self._page_info(p, include_users)
+            pobj['type'] = 'page'
+            yield json.dumps(pobj) + '\n'
+            for revobj in self._iter_revisions(p, include_history, include_users):
+                revobj['type'] = 'revision'
+                yield json.dumps(revobj) + '\n'
+        if self.user_ids:
+            yield json.dumps({'type': 'users', 'users': self._users_info()}) + '\n'
     def export(self):
-        return json.dumps(self.root)
+        return ''.join(self.iter_export())
 
 class Importer(object):
+    '''
+    Import pages from a JSON or NDJSON export, as made by Exporter.
+
+    NDJSON dumps are read one page at a time. Pages are inserted in bulk,
+    a chunk of pages per transaction; a page failing to import is skipped
+    without affecting the others.
+    '''
+    # pages per transaction
+    chunk_size = 50
+    # longest first line read to tell the format
+    peek_size = 1 << 20
+
     def __init__(self, dump, *, overwrite_urls = True):
-        self.root = json.loads(dump)
+        if isinstance(dump, (str, bytes, bytearray)):
+            dump = io.BytesIO(dump.encode('utf-8') if isinstance(dump, str) else dump)
+        self.dump = dump
         self.owner = None
         self.overwrite_urls = overwrite_urls
+        # pages of a classic JSON dump, parsed once
+        self._classic_pages = None
+        self._is_ndjson = self._detect_ndjson()
     def claim(self, owner):
         self.owner = owner
-    def execute(self):
+    def _detect_ndjson(self):
+        '''
+        Whether the dump is NDJSON: its first line is a whole record with
+        a "type" key. Classic dumps are a single object, on one line or more.
+        '''
+        self.dump.seek(0)
+        first_line = self.dump.readline(self.peek_size)
+        if not first_line.endswith(b'\n' if isinstance(first_line, bytes) else '\n'):
+            return False
+        try:
+            record = json.loads(first_line)
+        except ValueError:
+            return False
+        return isinstance(record, dict) and 'type' in record
+    def _iter_pages(self):
+        if not self._is_ndjson:
+            # classic JSON format, needs to be read whole
+            if self._classic_pages is None:
+                self.dump.seek(0)
+                self._classic_pages = json.load(self.dump)['pages']
+            yield from self._classic_pages
+            return
+        self.dump.seek(0)
+        pobj = None
+        for line in self.dump:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            rtype = record.pop('type', None)
+            if rtype == 'page':
+                if pobj is not None:
+                    yield pobj
+                pobj = record
+                pobj['history'] = []
+            elif rtype == 'revision' and pobj is not None:
+                pobj['history'].append(record)
+        if pobj is not None:
+            yield pobj
+    def _free_urls(self):
+        '''
+        Take URLs of imported pages away from existing pages. Return a dict
+        mapping each URL to the index of the last page in the dump having it,
+        which is the one getting it.
+        '''
+        url_owners = {}
+        for index, pobj in enumerate(self._iter_pages()):
+            if pobj.get('url'):
+                url_owners[pobj['url']] = index
+        urls = list(url_owners)
+        for i in range(0, len(urls), 500):
+            Page.update(url=None).where(Page.url.in_(urls[i:i+500])).execute()
+        return url_owners
+    def execute(self, progress=None):
+        '''
+        Import all pages. Return the number of pages and revisions imported.
+        If given, progress(no_pages, no_revs) is called after each chunk.
+        '''
         no_pages = 0
         no_revs = 0
-        for pobj in self.root['pages']:
-            purl = pobj.get("url")
-            try:
-                if purl:
+        url_owners = {}
+        if self.overwrite_urls:
+            with database.atomic():
+                url_owners = self._free_urls()
+        for chunk in _chunks(enumerate(self._iter_pages()), self.chunk_size):
+            with database.atomic():
+                texts, failed = self._save_texts([pobj for index, pobj in chunk])
+                imported = []
+                for k, (index, pobj) in enumerate(chunk):
+                    if k in failed:
+                        continue
+                    # the last page of the dump with an URL gets it
+                    url = pobj.get('url') if url_owners.get(pobj.get('url')) == index else None
                     try:
-                        p2 = Page.get(Page.url == purl)
-                        p2.url = None
-                        p2.save()
-                    except Page.DoesNotExist:
-                        pass
-
-                p = Page.create(
-                    url = purl if self.overwrite_urls else None,
-                    title = pobj['title'],
-                    calendar = datetime.datetime.fromisoformat(pobj["calendar"]) if 'calendar' in pobj else None,
-                    owner = self.owner.id,
-                    flags = pobj.get('flags'),
-                    touched = datetime.datetime.now()
-                )
-                p.change_tags(pobj.get('tags'))
-                no_pages += 1
-
-                for revobj in pobj['history']:
-                    textref = PageText.create_content(
-                        revobj['text']
-                    )
-
-                    rev = PageRevision.create(
-                        page = p,
-                        user_id = self.owner.id,
-                        textref = textref,
-                        comment = revobj.get('comment'),
-                        pub_date = datetime.datetime.fromtimestamp(revobj['timestamp']),
-                        length = revobj['length']
-                    )
-                    no_revs += 1
-            except Exception as e:
+                        with database.atomic():
+                            p = self._save_page(pobj, texts, url)
+                    except Exception:
+                        sys.excepthook(*sys.exc_info())
+                        continue
+                    imported.append(p)
+                    no_pages += 1
+                    no_revs += len(pobj['history'])
+                PageScore.refresh([p.id for p in imported])
+            if progress:
+                progress(no_pages, no_revs)
+        return no_pages, no_revs
+    def _save_texts(self, chunk):
+        '''
+        Store texts of a chunk of pages. Return a dict mapping digests to ids,
+        and the positions in chunk of the pages whose texts are not valid.
+        '''
+        by_digest = {}
+        failed = set()
+        for k, pobj in enumerate(chunk):
+            page_texts = {}
+            try:
+                for revobj in pobj.get('history', ()):
+                    text = revobj.get('text')
+                    if isinstance(text, str):
+                        page_texts[hashlib.sha256(text.encode('utf-8')).hexdigest()] = text
+            except Exception:
+                # e.g. lone surrogates, which cannot be stored
                 sys.excepthook(*sys.exc_info())
+                failed.add(k)
                 continue
-        return no_pages, no_revs
+            by_digest.update(page_texts)
+        digests = list(by_digest)
+        ids = {}
+        for part in _chunks(digests, 500):
+            ids.update(PageText.select(PageText.digest, PageText.id).where(PageText.digest.in_(part)).tuples())
+        rows = []
+        for digest in digests:
+            if digest not in ids:
+                pt = PageText(digest=digest, **PageText._encode(by_digest[digest]))
+                rows.append(pt.__data__)
+        for i in range(0, len(rows), 100):
+            PageText.insert_many(rows[i:i+100]).execute()
+        for part in _chunks([row['digest'] for row in rows], 500):
+            ids.update(PageText.select(PageText.digest, PageText.id).where(PageText.digest.in_(part)).tuples())
+        return ids, failed
+    def _save_page(self, pobj, texts, url):
+        p = Page.create(
+            url = url,
+            title = pobj['title'],
+            calendar = datetime.datetime.fromisoformat(pobj["calendar"]) if pobj.get('calendar') else None,
+            owner = self.owner.id,
+            flags = pobj.get('flags') or 0,
+            touched = datetime.datetime.now()
+        )
+        tags = set(pobj.get('tags') or ())
+        if tags:
+            PageTag.insert_many([dict(page=p.id, name=tag) for tag in tags]).execute()
+            TagStat.adjust(tags)
+        history = sorted(pobj['history'], key=lambda x: x['timestamp'])
+        rows = []
+        for revobj in history:
+            text = revobj['text']
+            rows.append(dict(
+                page = p.id,
+                user = self.owner.id,
+                textref = texts[hashlib.sha256(text.encode('utf-8')).hexdigest()],
+                comment = revobj.get('comment') or '',
+                pub_date = datetime.datetime.fromtimestamp(revobj['timestamp']),
+                length = len(text),
+                # only the latest revision is shown in listings
+                excerpt = make_excerpt(text) if revobj is history[-1] else None
+            ))
+        for i in range(0, len(rows), 100):
+            PageRevision.insert_many(rows[i:i+100]).execute()
+        if history:
+            p.latest_revision = (PageRevision.select(PageRevision.id)
+                .where(PageRevision.page == p.id)
+                .order_by(PageRevision.pub_date.desc(), PageRevision.id.desc()).get())
+            p.save()
+            search_index.update_page(p, text=history[-1]['text'], tags=tags)
+            PageLink.parse_links(p, history[-1]['text'])
+        PageLink.resolve_wanted(p)
+        response_cache.invalidate(p.id, tags)
+        _count_cache.clear()
+        return p
 
 @app.route('/manage/export/', methods=['GET', 'POST'])
 def exportpages():
@@ -1304,10 +3373,14 @@ def exportpages():
         query = q_list.pop(0)
         while q_list:
             query |= q_list.pop(0)
-        e = Exporter()
+        export_format = 'ndjson' if request.form.get('format') == 'ndjson' else 'json'
+        e = Exporter(format=export_format)
         e.add_page_list(query, include_history='history' in request.form)
-        return e.export(), {'Content-Type': 'application/json', 'Content-Disposition': 'attachment; ' + 
-            'filename=export-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))}
+        return Response(stream_with_context(e.iter_export()), headers={
+            'Content-Type': 'application/x-ndjson' if export_format == 'ndjson' else 'application/json',
+            'Content-Disposition': 'attachment; filename=export-{0}.{1}'.format(
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), export_format)
+        })
     return render_template('exportpages.jinja2')
 
 @app.route('/manage/import/', methods=['GET', 'POST'])
@@ -1317,7 +3390,7 @@ def importpages():
         if current_user.is_admin:
             f = request.files['import']
             overwrite_urls = request.form.get('ovwurls')
-            im = Importer(f.read(), overwrite_urls=overwrite_urls)
+            im = Importer(f.stream, overwrite_urls=overwrite_urls)
             im.claim(current_user)
             res = im.execute()
             flash('Imported successfully {} pages and {} revisions'.format(*res))
@@ -1328,8 +3401,7 @@ def importpages():
 @app.route('/manage/accounts/', methods=['GET', 'POST'])
 @login_required
 def manage_accounts():
-    users = User.select().order_by(User.join_date.desc())
-    page = int(request.args.get('page', 1))
+    users = User.select()
     if request.method == 'POST':
         if current_user.is_admin:
             action = request.form.get("action")
@@ -1352,7 +3424,7 @@ def manage_accounts():
                 flash("Unknown action")
         else:
             flash('Operation not permitted!')
-    return render_paginated_template('manageaccounts.jinja2', 'users', users=users)
+    return render_keyset_template('manageaccounts.jinja2', 'users', (User.join_date, User.id), users=users)
 
 ## terms / privacy ##
 
@@ -1368,6 +3440,94 @@ def privacy():
 def rules():
     return render_template('rules.jinja2')
 
+#### MAINTENANCE COMMANDS ####
+
+@app.cli.command('rebuild-render-cache')
+@click.option('--all', 'all_revisions', is_flag=True, help='Render old revisions too.')
+def _rebuild_render_cache(all_revisions):
+    '''
+    Drop stale rendered HTML and render pages again.
+    Run this after changing Markdown extensions.
+    '''
+    n = PageRender.rebuild(all_revisions=all_revisions)
+    print('{0} revisions rendered.'.format(n))
+
+@app.cli.command('backfill-excerpts')
+@click.option('--force', is_flag=True, help='Recompute existing excerpts too.')
+def _backfill_excerpts(force):
+    '''
+    Compute listing excerpts for revisions saved before 0.9.
+    '''
+    query = PageRevision.select()
+    if not force:
+        query = query.where(PageRevision.excerpt.is_null())
+    n = 0
+    with database.atomic():
+        for rev in query.iterator():
+            PageRevision.update(excerpt=make_excerpt(rev.text)).where(PageRevision.id == rev.id).execute()
+            n += 1
+    print('{0} excerpts computed.'.format(n))
+
+@app.cli.command('refresh-links')
+@click.option('--workers', type=int, default=None, help='Processes used to parse pages (default: one per CPU).')
+def _refresh_links(workers):
+    '''
+    Rebuild the link graph, and leaderboard scores, from the latest text of all pages.
+    '''
+    n = PageLink.refresh_all_links(workers=workers)
+    print('Links of {0} pages refreshed.'.format(n))
+
+@app.cli.command('refresh-tag-stats')
+def _refresh_tag_stats():
+    '''
+    Count again the pages with each tag.
+    '''
+    TagStat.refresh_all()
+    print('Tag counts refreshed.')
+
+@app.cli.command('refresh-scores')
+def _refresh_scores():
+    '''
+    Recompute leaderboard scores of all pages.
+    '''
+    PageScore.refresh_all()
+    print('Scores refreshed.')
+
+@app.cli.command('reindex-search')
+def _reindex_search():
+    '''
+    Build the search index again from the latest text of all pages.
+    '''
+    search_index.create_table()
+    n = search_index.rebuild()
+    print('{0} pages indexed.'.format(n))
+
+@app.cli.command('repack-texts')
+def _repack_texts():
+    '''
+    Store old revisions as deltas. Requires [storage]deltas = 1.
+    '''
+    if not _getconf('storage', 'deltas', 0, cast=int):
+        print('Delta storage is disabled. Set [storage]deltas = 1 in site.conf first.')
+        return
+    size_before, size_after = PageText.repack()
+    print('Stored texts: {0} bytes, now {1} bytes ({2} bytes saved).'.format(
+        size_before, size_after, size_before - size_after))
+
+@app.cli.command('import-pages')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.option('--owner', required=True, help='Username of the owner of imported pages.')
+@click.option('--keep-urls', is_flag=True, help='Do not take URLs away from existing pages.')
+def _import_pages(filename, owner, keep_urls):
+    '''
+    Import pages from a JSON or NDJSON export file.
+    '''
+    with open(filename, 'rb') as f:
+        im = Importer(f, overwrite_urls=not keep_urls)
+        im.claim(User.get(User.username == owner))
+        res = im.execute(progress=lambda p, r: print('{0} pages, {1} revisions...'.format(p, r)))
+    print('Imported successfully {} pages and {} revisions'.format(*res))
+
 #### EXTENSIONS ####
 
 active_extensions = []
@@ -0,0 +1,264 @@
+"""
+Benchmarks for Salvi.
+
+Usage: python3 -m app_bench [markdown] [routes] [--pages N] [--revisions M] ...
+
+The routes benchmark generates a synthetic wiki in a scratch SQLite
+database (never the configured one, and removed on exit), then drives the
+hot routes through the Flask test client. If a response cache is
+configured, a private one in memory is used. Use --json to save results
+and compare runs.
+"""
+
+import argparse, atexit, io, json, os, random, shutil, sys, tempfile, time, timeit
+
+# never touch the configured database
+_bench_dir = tempfile.mkdtemp(prefix="salvi-bench-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_bench_dir, "bench.sqlite")
+
+import markdown
+import app as salvi
+from app import _markdown_extensions, _percentile, render_markdown
+
+# nor the configured response cache: keep a private one in memory instead
+if salvi.response_cache.enabled:
+    salvi.response_cache = salvi.MemoryResponseCache(max_items=salvi._getconf('cache', 'max_items', 1000, cast=int))
+
+@atexit.register
+def _remove_bench_dir():
+    salvi.database.close()
+    shutil.rmtree(_bench_dir, ignore_errors=True)
+
+#### SAMPLE TEXTS ####
+
+SHORT_TEXT = "Some *short* note, linking [another page](/another-page/).\n"
+
+LONG_TEXT = "\n\n".join(
+    "## Section {0}\n\nParagraph with **bold**, ~~struck~~ and `code` text.\n\n"
+    "| a | b |\n|---|---|\n| {0} | {0} |\n\n+ item\n+ item[^{0}]\n\n[^{0}]: Footnote.".format(i)
+    for i in range(30)
+)
+
+#### BENCHMARKS ####
+
+def _per_call(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+def bench_markdown(number=200):
+    '''
+    Compare building a new Markdown converter on each call (as it was
+    before 0.9) with reusing a pooled one. Reuse saves the setup time
+    of a converter: a large share of short renders, e.g. in listings,
+    and within the noise of long ones.
+    '''
+    for toc in (False, True):
+        setup = _per_call(lambda: markdown.Markdown(extensions=_markdown_extensions(toc)), number)
+        print("converter setup{0}: {1:.1f} us per call".format(" +toc" if toc else "", setup * 1e6))
+    print("{0:<12} {1:>14} {2:>14} {3:>10}".format("text", "fresh (us)", "pooled (us)", "speedup"))
+    for name, text in (("short", SHORT_TEXT), ("long", LONG_TEXT)):
+        for toc in (False, True):
+            fresh = _per_call(lambda: markdown.Markdown(extensions=_markdown_extensions(toc)).convert(text), number)
+            pooled = _per_call(lambda: render_markdown(text, toc=toc), number)
+            print("{0:<12} {1:>14.1f} {2:>14.1f} {3:>9.1f}x".format(
+                name + (" +toc" if toc else ""), fresh * 1e6, pooled * 1e6, fresh / pooled))
+
+#### SYNTHETIC WIKI ####
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt "
+    "labore dolore magna aliqua enim minim veniam quis nostrud exercitation ullamco laboris "
+    "nisi aliquip commodo consequat duis aute irure reprehenderit voluptate velit esse cillum "
+    "fugiat nulla pariatur excepteur sint occaecat cupidatat proident sunt culpa officia"
+).split()
+
+def _sentence(rng, n_pages):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    if rng.random() < 0.4:
+        # internal link, matching ILINK_RE
+        i = rng.randrange(n_pages)
+        target = "p/{0}".format(i + 1) if rng.random() < 0.2 else "page-{0}".format(i)
+        words.insert(rng.randrange(len(words)), "[{0}](/{1}/)".format(rng.choice(WORDS), target))
+    if rng.random() < 0.2:
+        words[0] = "**{0}**".format(words[0])
+    return " ".join(words).capitalize() + "."
+
+def make_text(rng, n_pages, paragraphs=8):
+    blocks = []
+    for k in range(paragraphs):
+        r = rng.random()
+        if r < 0.15:
+            blocks.append("## " + " ".join(rng.choice(WORDS) for _ in range(3)).capitalize())
+        elif r < 0.3:
+            blocks.append("\n".join("+ " + _sentence(rng, n_pages) for _ in range(rng.randint(2, 5))))
+        else:
+            blocks.append(" ".join(_sentence(rng, n_pages) for _ in range(rng.randint(2, 6))))
+    return "\n\n".join(blocks) + "\n"
+
+def make_tags(rng):
+    # a few popular tags, and a long tail
+    n = rng.randint(0, 4)
+    return sorted({"tag-{0}".format(min(int(rng.paretovariate(1.2)), 200)) for _ in range(n)})
+
+def generate_wiki(n_pages, n_revisions, seed=0):
+    '''
+    Fill the scratch database with n_pages pages of n_revisions revisions
+    each. Return the admin user.
+    '''
+    rng = random.Random(seed)
+    salvi.init_db()
+    admin = salvi.User.create(username="admin", password=salvi.generate_password_hash("admin"),
+        is_admin=True, join_date=salvi.datetime.datetime.now())
+    group = salvi.UserGroup.create(name="default", permissions=31)
+    salvi.UserGroupMembership.create(user=admin, group=group)
+    start = time.time() - n_pages * n_revisions * 60
+    with salvi.database.atomic():
+        for i in range(n_pages):
+            p = salvi.Page.create(
+                url="page-{0}".format(i) if rng.random() < 0.9 else None,
+                title=" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(),
+                is_redirect=False,
+                touched=salvi.datetime.datetime.fromtimestamp(start + i * n_revisions * 60),
+                owner_id=admin.id,
+                calendar=salvi.datetime.date(2020 + rng.randrange(5), rng.randint(1, 12), rng.randint(1, 28))
+                    if rng.random() < 0.3 else None
+            )
+            p.change_tags(make_tags(rng))
+            text = make_text(rng, n_pages)
+            for j in range(n_revisions):
+                if j:
+                    # edit a few paragraphs
+                    blocks = text.split("\n\n")
+                    blocks[rng.randrange(len(blocks))] = make_text(rng, n_pages, 1).strip()
+                    text = "\n\n".join(blocks)
+                p.add_revision(text, user_id=admin.id,
+                    pub_date=salvi.datetime.datetime.fromtimestamp(start + (i * n_revisions + j) * 60))
+    salvi.PageLink.refresh_all_links(workers=1)
+    return admin
+
+#### ROUTES ####
+
+class QueryCounter(object):
+    def __init__(self, database):
+        self.count = 0
+        self._execute_sql = database.execute_sql
+        database.execute_sql = self._counted
+    def _counted(self, *args, **kwargs):
+        self.count += 1
+        return self._execute_sql(*args, **kwargs)
+
+def _route_cases(rng, n_pages, tags, admin_client, anon_client, export_dump):
+    '''
+    (name, client, method, path or callable, request kwargs)
+    '''
+    page_urls = [p.get_url() for p in salvi.Page.select(salvi.Page.id, salvi.Page.url)]
+    def page_url():
+        return rng.choice(page_urls)
+    edit_counter = iter(range(10 ** 9))
+    return [
+        ("view", anon_client, "get", page_url, {}),
+        ("view (admin)", admin_client, "get", page_url, {}),
+        ("home", anon_client, "get", "/", {}),
+        ("most_recent", anon_client, "get", "/p/most_recent/", {}),
+        ("tag list", anon_client, "get", lambda: "/tags/{0}/".format(rng.choice(tags)), {}),
+        ("tags", anon_client, "get", "/tags/", {}),
+        ("search", anon_client, "get", lambda: "/search/?q={0}".format(rng.choice(WORDS)), {}),
+        ("leaderboard", anon_client, "get", "/p/leaderboard/", {}),
+        ("history", anon_client, "get", lambda: "/history/{0}/".format(rng.randint(1, n_pages)), {}),
+        ("export", admin_client, "post", "/manage/export/",
+            lambda: dict(data={"export-list": "#" + rng.choice(tags), "history": "1"})),
+        ("import", admin_client, "post", "/manage/import/",
+            lambda: dict(data={"import": (io.BytesIO(export_dump), "dump.json")},
+                content_type="multipart/form-data")),
+        ("create", admin_client, "post", "/create/",
+            lambda: dict(data=dict(url="", title="New page", text=make_text(rng, n_pages),
+                tags=",".join(make_tags(rng)), comment=""))),
+        ("edit", admin_client, "post", lambda: "/edit/{0}/".format(rng.randint(1, n_pages)),
+            lambda: dict(data=dict(url="", title="Edited page {0}".format(next(edit_counter)),
+                text=make_text(rng, n_pages), tags=",".join(make_tags(rng)), comment="bench"))),
+    ]
+
+def bench_routes(pages=200, revisions=5, requests=50, seed=0, only=None, json_file=None):
+    '''
+    Generate a synthetic wiki, and time the hot routes on it.
+    '''
+    t0 = time.perf_counter()
+    generate_wiki(pages, revisions, seed=seed)
+    print("generated {0} pages x {1} revisions in {2:.1f} s ({3})".format(
+        pages, revisions, time.perf_counter() - t0, _bench_dir))
+    if salvi.response_cache.enabled:
+        print("note: response cache is enabled (a private {0})".format(type(salvi.response_cache).__name__))
+    salvi.app.config["WTF_CSRF_ENABLED"] = False
+    salvi.app.config["TESTING"] = True
+    anon_client = salvi.app.test_client()
+    admin_client = salvi.app.test_client()
+    admin_client.post("/accounts/login/", data=dict(username="admin", password="admin", remember="0"))
+    export_dump = admin_client.post("/manage/export/", data={"export-list": "/page-1/\n/page-2/", "history": "1"}).data
+    tags = [x.name for x in salvi.TagStat.select().order_by(salvi.TagStat.count.desc()).limit(20)] or ["tag-1"]
+    counter = QueryCounter(salvi.database)
+    rng = random.Random(seed)
+    results = {}
+    print("{0:<14} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>8} {7:>8}".format(
+        "route", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "queries", "q max"))
+    for name, client, method, path, kwargs in _route_cases(rng, pages, tags, admin_client, anon_client, export_dump):
+        if only and name not in only:
+            continue
+        times, queries = [], []
+        for k in range(requests + 3):
+            url = path() if callable(path) else path
+            kw = kwargs() if callable(kwargs) else kwargs
+            counter.count = 0
+            start = time.perf_counter()
+            resp = getattr(client, method)(url, **kw)
+            resp.get_data()
+            elapsed = time.perf_counter() - start
+            if resp.status_code >= 400:
+                raise RuntimeError("{0} {1}: HTTP {2}".format(method.upper(), url, resp.status_code))
+            if k >= 3:
+                # the first requests warm up caches
+                times.append(elapsed * 1000)
+                queries.append(counter.count)
+        results[name] = dict(
+            rps=len(times) / (sum(times) / 1000),
+            p50=_percentile(times, 50), p95=_percentile(times, 95),
+            p99=_percentile(times, 99), max=max(times),
+            queries=sum(queries) / len(queries), queries_max=max(queries)
+        )
+        r = results[name]
+        print("{0:<14} {1:>8.1f} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>8.1f} {7:>8}".format(
+            name, r["rps"], r["p50"], r["p95"], r["p99"], r["max"], r["queries"], r["queries_max"]))
+    if json_file:
+        with open(json_file, "w") as f:
+            json.dump(dict(pages=pages, revisions=revisions, requests=requests, seed=seed,
+                version=salvi.__version__, routes=results), f, indent=2)
+
+BENCHMARKS = {
+    "markdown": bench_markdown,
+    "routes": bench_routes,
+}
+
+#### MAIN ####
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Salvi.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--pages", type=int, default=200, help="pages of the synthetic wiki")
+    parser.add_argument("--revisions", type=int, default=5, help="revisions of each page")
+    parser.add_argument("--requests", type=int, default=50, help="timed requests per route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--route", action="append", help="only time these routes")
+    parser.add_argument("--json", help="save route results to this file")
+    args = parser.parse_args()
+    for name in args.names or list(BENCHMARKS):
+        if name not in BENCHMARKS:
+            print("unknown benchmark:", name, file=sys.stderr)
+            continue
+        print("\x1b[1m{0}\x1b[0m".format(name))
+        if name == "routes":
+            bench_routes(pages=args.pages, revisions=args.revisions, requests=args.requests,
+                seed=args.seed, only=args.route, json_file=args.json)
+        else:
+            BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,18 @@
 Helper module for sync.
 
 Remember to set sync:master variable in site.conf!
+The master must run version 0.9 or later.
 
 (c) 2021 Sakuragasaki46.
 """
 
-import datetime, time
+import datetime, json, time
 import requests
-import sys, os
+import sys, os, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from app import Page, PageRevision, PageText
+from app import Page, PageLink, database, _chunks, JSONINFO_BATCH_LIMIT
 from peewee import IntegrityError
 from functools import lru_cache
 
@@ -32,13 +35,18 @@ DEFAULT_CONF = {
 _cfp = ConfigParser()
 if _cfp.read([APP_BASE_DIR + '/site.conf']):
     @lru_cache(maxsize=50)
-    def _getconf(k1, k2, fallback=None):
+    def _getconf(k1, k2, fallback=None, cast=None):
         if fallback is None:
             fallback = DEFAULT_CONF.get((k1, k2))
         v = _cfp.get(k1, k2, fallback=fallback)
+        if cast in (int, float, str):
+            try:
+                v = cast(v)
+            except ValueError:
+                v = fallback
         return v
 else:
-    def _getconf(k1, k2, fallback=None):
+    def _getconf(k1, k2, fallback=None, cast=None):
         if fallback is None:
             fallback = DEFAULT_CONF.get((k1, k2))
         return fallback
@@ -55,27 +63,215 @@ def _makelist(l):
     else:
         return []
 
-#### REQUESTS ####
+#### CHECKPOINT ####
+
+def _checkpoint_path():
+    return _getconf("config", "database_dir") + "/last_sync"
 
-def fetch_updated_ids(baseurl):
+def load_checkpoint():
+    """
+    Return (last_sync, pending), where pending holds the start time and
+    the page ids left over by an interrupted run, or None.
+    """
     try:
-        with open(_getconf("config", "database_dir") + "/latest_sync") as f:
+        with open(_checkpoint_path()) as f:
             last_sync = float(f.read().rstrip("\n"))
     except (OSError, ValueError):
         last_sync = 946681200.0  # Jan 1, 2000
-    r = requests.get(baseurl + "/_jsoninfo/changed/{ts}".format(ts=last_sync))
-    if r.status_code >= 400:
-        raise RuntimeError("sync unavailable")
-    return r.json()["ids"]
+    try:
+        with open(_checkpoint_path() + ".pending") as f:
+            pending = json.load(f)
+    except (OSError, ValueError):
+        pending = None
+    return last_sync, pending
 
-def update_contacts(baseurl):
-    from extensions.contactnova import Contact
+def save_checkpoint(last_sync=None, pending=None):
+    if last_sync is not None:
+        with open(_checkpoint_path(), "w") as fw:
+            fw.write(str(last_sync))
+    if pending:
+        with open(_checkpoint_path() + ".pending", "w") as fw:
+            json.dump(pending, fw)
+    else:
+        try:
+            os.remove(_checkpoint_path() + ".pending")
+        except OSError:
+            pass
+
+def load_failed():
+    """
+    Return the ids of pages which failed to sync, with their attempts.
+    """
     try:
-        with open(_getconf("config", "database_dir") + "/latest_sync") as f:
-            last_sync = float(f.read().rstrip("\n"))
+        with open(_checkpoint_path() + ".failed") as f:
+            return {int(k): v for k, v in json.load(f).items()}
     except (OSError, ValueError):
-        last_sync = 946681200.0  # Jan 1, 2000
-    r = requests.get(baseurl + "/kt/_jsoninfo/{ts}".format(ts=last_sync))
+        return {}
+
+def save_failed(failed):
+    if failed:
+        with open(_checkpoint_path() + ".failed", "w") as fw:
+            json.dump(failed, fw)
+    else:
+        try:
+            os.remove(_checkpoint_path() + ".failed")
+        except OSError:
+            pass
+
+#### REQUESTS ####
+
+class SyncClient(object):
+    """
+    Fetch changed pages from the master, and apply them.
+
+    Any object with a requests.Session-like get() method can
+    be passed as session, e.g. to sync against a local stand-in master;
+    it is then shared by all workers. Otherwise each worker thread gets
+    its own requests.Session.
+    """
+    def __init__(self, baseurl, *, session=None, workers=None, batch_size=None):
+        self.baseurl = baseurl.rstrip("/")
+        self._shared_session = session
+        self._local = threading.local()
+        self.workers = workers or _getconf("sync", "workers", 4, cast=int)
+        self.batch_size = batch_size or _getconf("sync", "batch_size", 50, cast=int)
+        # the master rejects larger batches
+        self.fetch_size = min(_getconf("sync", "fetch_size", 100, cast=int), JSONINFO_BATCH_LIMIT)
+        self.max_attempts = _getconf("sync", "max_attempts", 5, cast=int)
+
+    @property
+    def session(self):
+        if self._shared_session is not None:
+            return self._shared_session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def fetch_updated_ids(self, last_sync):
+        ids = []
+        cursor = None
+        while True:
+            url = self.baseurl + "/_jsoninfo/changed/{ts}".format(ts=float(last_sync))
+            r = self.session.get(url + ("?cursor=" + cursor if cursor else ""))
+            if r.status_code >= 400:
+                raise RuntimeError("sync unavailable")
+            data = r.json()
+            ids.extend(data["ids"])
+            # masters before 0.9 return all ids at once
+            cursor = data.get("next")
+            if not cursor:
+                return ids
+
+    def fetch_batch(self, ids):
+        """
+        Fetch many pages in one request. Return a dict of pageinfo by id.
+        """
+        r = self.session.get(self.baseurl + "/_jsoninfo/batch",
+            params={"ids": ",".join(str(i) for i in ids)})
+        if r.status_code == 404:
+            # masters before 0.9 only give texts through POST requests,
+            # which their CSRF protection rejects
+            raise RuntimeError("master must be 0.9 or later")
+        if r.status_code >= 400:
+            raise RuntimeError("HTTP {s}".format(s=r.status_code))
+        return {p["id"]: p for p in r.json()["pages"]}
+
+    def fetch_pages(self, ids):
+        """
+        Fetch pages in parallel batches. Yield (id, pageinfo or exception).
+        At most two batches per worker are fetched ahead of the consumer.
+        """
+        chunks = _chunks(ids, self.fetch_size)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = deque()
+            def submit_next():
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    futures.append((chunk, pool.submit(self.fetch_batch, chunk)))
+            for _ in range(2 * self.workers):
+                submit_next()
+            while futures:
+                chunk, fut = futures.popleft()
+                submit_next()
+                try:
+                    pages = fut.result()
+                except Exception as e:
+                    pages = {}
+                    error = e
+                else:
+                    error = RuntimeError("not found")
+                for i in chunk:
+                    yield i, pages.get(i, error)
+
+    def apply_batch(self, batch):
+        """
+        Apply a batch of (id, pageinfo) in a transaction.
+        Return the ids which failed.
+        """
+        failed = []
+        with database.atomic():
+            for i, pageinfo in batch:
+                try:
+                    with database.atomic():
+                        apply_page(i, pageinfo)
+                except IntegrityError:
+                    print("\x1b[31mSkipping {i}: Integrity error\x1b[0m".format(i=i))
+                    failed.append(i)
+                except Exception as e:
+                    print("\x1b[31mSkipping {i}: {t}: {e}\x1b[0m".format(i=i, t=type(e).__name__, e=e))
+                    failed.append(i)
+        return failed
+
+    def sync(self):
+        """
+        Sync pages changed since last run, resuming an interrupted run
+        if needed, and retry the pages which failed before.
+        Return (passed, failed).
+        """
+        last_sync, pending = load_checkpoint()
+        failed = load_failed()
+        started = time.time()
+        if pending:
+            # pages changed before the interrupted run are in its leftover ids
+            ids = pending["ids"] + self.fetch_updated_ids(pending["started"])
+        else:
+            ids = self.fetch_updated_ids(last_sync)
+        ids = list(dict.fromkeys(ids + list(failed)))
+        passed, n_failed = 0, 0
+        done = 0
+        for batch in _chunks(self.fetch_pages(ids), self.batch_size):
+            ok, batch_failed = [], []
+            for i, res in batch:
+                if isinstance(res, Exception):
+                    print("\x1b[31mSkipping {i}: {e}\x1b[0m".format(i=i, e=res))
+                    batch_failed.append(i)
+                else:
+                    ok.append((i, res))
+            apply_failed = self.apply_batch(ok)
+            batch_failed.extend(apply_failed)
+            for i, _ in ok:
+                if i not in apply_failed:
+                    failed.pop(i, None)
+            for i in batch_failed:
+                failed[i] = failed.get(i, 0) + 1
+                if failed[i] >= self.max_attempts:
+                    print("\x1b[31mGiving up on {i} after {n} attempts\x1b[0m".format(i=i, n=failed[i]))
+                    del failed[i]
+            passed += len(ok) - len(apply_failed)
+            n_failed += len(batch_failed)
+            done += len(batch)
+            # resume from here if interrupted
+            save_failed(failed)
+            save_checkpoint(pending=dict(started=started, ids=ids[done:]))
+        # failed pages are retried on next runs, up to max_attempts
+        save_checkpoint(last_sync=started)
+        return passed, n_failed
+
+def update_contacts(baseurl, session=None):
+    from extensions.contactnova import Contact
+    last_sync, pending = load_checkpoint()
+    r = (session or requests).get(baseurl + "/kt/_jsoninfo/{ts}".format(ts=last_sync))
     if r.status_code >= 400:
         raise RuntimeError("sync unavailable")
     # update contacts
@@ -104,20 +300,44 @@ def update_contacts(baseurl):
     
 
 def update_page(p, pageinfo):
+    old_title, old_url = p.title, p.url
     p.touched = datetime.datetime.fromtimestamp(pageinfo["touched"])
     p.url = pageinfo["url"]
     p.title = pageinfo["title"]
     p.save()
+    if p.title != old_title:
+        p.invalidate_link_targets()
     p.change_tags(pageinfo["tags"])
-    assert len(pageinfo["text"]) == pageinfo["latest"]["length"]
-    pr = PageRevision.create(
-        page=p,
-        user_id=0,
-        comment='',
-        textref=PageText.create_content(pageinfo['text']),
-        pub_date=datetime.datetime.fromtimestamp(pageinfo["latest"]["pub_date"]),
-        length=pageinfo["latest"]["length"]
-    )
+    if len(pageinfo["text"]) != pageinfo["latest"]["length"]:
+        raise ValueError("text length {0} does not match {1}".format(
+            len(pageinfo["text"]), pageinfo["latest"]["length"]))
+    if p.latest is None or p.latest.text != pageinfo["text"]:
+        p.add_revision(pageinfo['text'],
+            user_id=0,
+            pub_date=datetime.datetime.fromtimestamp(pageinfo["latest"]["pub_date"])
+        )
+        PageLink.parse_links(p, pageinfo["text"])
+    if p.url and p.url != old_url:
+        PageLink.resolve_wanted(p)
+
+def apply_page(i, pageinfo):
+    try:
+        p = Page[i]
+    except Page.DoesNotExist:
+        p = Page.create(
+            id=i,
+            url=pageinfo['url'],
+            title=pageinfo['title'],
+            is_redirect=pageinfo['is_redirect'],
+            touched=datetime.datetime.fromtimestamp(pageinfo["touched"]),
+            is_sync = True
+        )
+        update_page(p, pageinfo)
+        # also turns wanted links to p/<id> into links
+        PageLink.resolve_wanted(p)
+    else:
+        if pageinfo["touched"] > p.touched.timestamp():
+            update_page(p, pageinfo)
 
 #### MAIN ####
 
@@ -129,42 +349,13 @@ def main():
     if not baseurl.startswith(("http:", "https:")):
         print("unsyncable: invalid url", repr(baseurl), file=sys.stderr)
         return
-    passed, failed = 0, 0
-    for i in fetch_updated_ids(baseurl):
-        pageinfo_r = requests.post(baseurl + "/_jsoninfo/{i}".format(i=i))
-        if pageinfo_r.status_code >= 400:
-            print("\x1b[31mSkipping {i}: HTTP {s}\x1b[0m".format(i=i, s=pageinfo_r.status_code))
-            failed += 1
-            continue
-        pageinfo = pageinfo_r.json()
-        try:
-            p = Page[i]
-        except Page.DoesNotExist:
-            try:
-                p = Page.create(
-                    id=i,
-                    url=pageinfo['url'],
-                    title=pageinfo['title'],
-                    is_redirect=pageinfo['is_redirect'],
-                    touched=datetime.datetime.fromtimestamp(pageinfo["touched"]),
-                    is_sync = True
-                )
-                update_page(p, pageinfo)
-            except IntegrityError:
-                print("\x1b[31mSkipping {i}: Integrity error\x1b[0m".format(i=i))
-                failed += 1
-                continue
-        else:
-            if pageinfo["touched"] > p.touched.timestamp():
-                update_page(p, pageinfo)
-        passed += 1
+    client = SyncClient(baseurl)
     try:
         if _getconf("sync", "contacts", None) is not None:
-            update_contacts(baseurl)
+            update_contacts(baseurl, client.session)
     except Exception as e:
         print("\x1b[33mContacts not updated - {e} :(\x1b[0m".format(e=e))
-    with open(DATABASE_DIR + "/last_sync", "w") as fw:
-        fw.write(str(time.time()))
+    passed, failed = client.sync()
     if passed > 0 and failed == 0:
         print("\x1b[32mSuccessfully updated {p} pages :)\x1b[0m".format(p=passed))
     else:
@@ -7,7 +7,7 @@ Circles (people) extension for Salvi.
 
 from peewee import *
 import datetime
-from app import _getconf
+from app import _getconf, connect_database, manage_connections
 from flask import Blueprint, request, redirect, render_template
 from werkzeug.routing import BaseConverter
 import csv
@@ -43,7 +43,7 @@ def _putmbt(s):
 
 #### DATABASE SCHEMA ####
 
-database = SqliteDatabase(_getconf("config", "database_dir") + '/circles.sqlite')
+database = connect_database('sqlite:///' + _getconf("config", "database_dir") + '/circles.sqlite')
 
 class BaseModel(Model):
     class Meta:
@@ -138,6 +138,7 @@ def _register_converters(state):
 bp = Blueprint('circles', __name__,
                url_prefix='/circles')
 bp.record_once(_register_converters)
+manage_connections(database, bp, 'circles')
 
 @bp.route('/init-config')
 def _init_config():
@@ -7,7 +7,7 @@ Contact Nova extension for Salvi.
 
 from peewee import *
 import datetime
-from app import _getconf
+from app import _getconf, connect_database, manage_connections
 from flask import Blueprint, request, redirect, render_template, jsonify, abort
 from werkzeug.routing import BaseConverter
 import csv
@@ -33,7 +33,7 @@ def now7days():
     
 #### DATABASE SCHEMA ####
 
-database = SqliteDatabase(_getconf("config", "database_dir") + '/contactnova.sqlite')
+database = connect_database('sqlite:///' + _getconf("config", "database_dir") + '/contactnova.sqlite')
 
 class BaseModel(Model):
     class Meta:
@@ -127,6 +127,7 @@ def paginate_list(cat, q):
 bp = Blueprint('contactnova', __name__,
                url_prefix='/kt')
 bp.record_once(_register_converters)
+manage_connections(database, bp, 'contactnova')
 
 @bp.route('/init-config')
 def _init_config():
@@ -0,0 +1,48 @@
+from playhouse.migrate import migrate, SqliteMigrator, MySQLMigrator
+from peewee import MySQLDatabase, SqliteDatabase, CharField, IntegerField
+import hashlib
+from app import database, Page, PageRevision, PageText, PageRender, PageScore, PageLink, \
+    PageWantedLink, TagStat, PageDiff, search_index
+
+
+if isinstance(database, MySQLDatabase):
+    migrator = MySQLMigrator(database)
+elif isinstance(database, SqliteDatabase):
+    migrator = SqliteMigrator(database)
+else:
+    print("Unsupported database")
+    exit()
+
+with database.atomic():
+    database.create_tables([PageRender, PageScore, PageWantedLink, TagStat, PageDiff])
+    migrate(
+        migrator.add_column('pagerevision', 'excerpt', CharField(256, null=True)),
+        migrator.add_column('page', 'latest_revision_id', IntegerField(null=True)),
+        migrator.add_index('pagerevision', ('page_id', 'pub_date'), False),
+        migrator.add_index('pagerevision', ('user_id', 'pub_date'), False),
+        migrator.add_column('pagetext', 'digest', CharField(64, null=True)),
+        migrator.add_column('pagetext', 'base_id', IntegerField(null=True)),
+        migrator.add_index('pagetext', ('base_id',), False)
+    )
+    # backfill PageText.digest; duplicates already stored are left without
+    seen_digests = set()
+    for pt in PageText.select().iterator():
+        digest = hashlib.sha256(pt.get_content().encode('utf-8')).hexdigest()
+        if digest not in seen_digests:
+            seen_digests.add(digest)
+            PageText.update(digest=digest).where(PageText.id == pt.id).execute()
+    migrate(
+        migrator.add_index('pagetext', ('digest',), True)
+    )
+    # backfill Page.latest_revision
+    Page.update(latest_revision=(
+        PageRevision.select(PageRevision.id)
+        .where(PageRevision.page == Page.id)
+        .order_by(PageRevision.pub_date.desc(), PageRevision.id.desc())
+        .limit(1)
+    )).execute()
+    # also fills PageWantedLink, and computes scores
+    PageLink.refresh_all_links(workers=1)
+    TagStat.refresh_all()
+    search_index.create_table()
+    search_index.rebuild()
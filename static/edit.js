@@ -75,6 +75,37 @@
   // TODO tag editor
   var tagsInput = getFirst(document.getElementsByClassName('tags-input'));
 
+  // tag autocomplete
+  var tagsDatalist = document.createElement('datalist');
+  tagsDatalist.id = 'tags-datalist';
+  tagsInput.parentNode.appendChild(tagsDatalist);
+  tagsInput.setAttribute('list', 'tags-datalist');
+  tagsInput.setAttribute('autocomplete', 'off');
+  var tagsLastPrefix = null;
+  tagsInput.addEventListener('input', function(){
+    var parts = tagsInput.value.split(',');
+    var prefix = parts.pop().trim().replace(/^#/, '');
+    if (prefix === tagsLastPrefix) return;
+    tagsLastPrefix = prefix;
+    if (!prefix) {
+      tagsDatalist.innerHTML = '';
+      return;
+    }
+    var before = parts.length ? parts.join(',') + ',' : '';
+    fetch('/_jsoninfo/tags?q=' + encodeURIComponent(prefix)).then(function(r){
+      return r.json();
+    }).then(function(data){
+      if (prefix !== tagsLastPrefix) return;
+      tagsDatalist.innerHTML = '';
+      data.tags.forEach(function(tag){
+        var option = document.createElement('option');
+        option.value = before + tag.name;
+        option.label = tag.name + ' (' + tag.count + ')';
+        tagsDatalist.appendChild(option);
+      });
+    });
+  });
+
   // draft management
   function autosaveText(){
     localStorage.setItem('draft' + (page_info.editing.page_id || 'new'), textInput.value);
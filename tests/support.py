@@ -0,0 +1,50 @@
+"""
+Shared setup of the tests: the app on a temporary SQLite database, with
+an admin user (id 1) and the default group.
+
+Import this before app in every test module.
+"""
+
+import atexit, datetime, os, sys, shutil, tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmp, "data.sqlite")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+app.init_db()
+admin = app.User.create(username="admin", password="", join_date=datetime.datetime.now(), is_admin=True)
+app.UserGroupMembership.create(user=admin,
+    group=app.UserGroup.create(name="default", permissions=int(app.PERM_ALL)))
+
+
+@atexit.register
+def _cleanup():
+    app.database.close()
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+def tempdir():
+    return tempfile.mkdtemp(dir=_tmp)
+
+
+def create_page(url, text="Hello", *, title=None, tags=(), page_id=None):
+    """
+    Create a page the way the editor does, links included.
+    """
+    with app.app.test_request_context():
+        p = app.Page.create(url=url, title=title or url.title(), is_redirect=False,
+            touched=datetime.datetime.now(), owner_id=admin.id, **({"id": page_id} if page_id else {}))
+        if tags:
+            p.change_tags(tags)
+        p.add_revision(text, user_id=admin.id)
+        app.PageLink.parse_links(p, text)
+        app.PageLink.resolve_wanted(p)
+    return p
+
+
+def login(client, user=admin):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user.id)
+        session["_fresh"] = True
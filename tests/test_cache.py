@@ -0,0 +1,67 @@
+"""
+Tests for the response cache of anonymous page views.
+
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+from unittest import mock
+
+import support
+import app
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(app, "response_cache", app.MemoryResponseCache(max_items=100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def get(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return r
+
+    def test_second_view_is_cached(self):
+        support.create_page("cache-first")
+        self.get("/cache-first/")
+        self.assertEqual(self.get("/cache-first/").headers.get("X-Cache"), "HIT")
+
+    def test_new_revision_invalidates(self):
+        p = support.create_page("cache-revised", "Old text")
+        self.get("/cache-revised/")
+        with app.app.test_request_context():
+            p.add_revision("New text", user_id=support.admin.id)
+        r = self.get("/cache-revised/")
+        self.assertIsNone(r.headers.get("X-Cache"))
+        self.assertIn(b"New text", r.data)
+
+    def test_new_backlink_invalidates(self):
+        support.create_page("cache-target")
+        self.get("/cache-target/")
+        support.create_page("cache-linking", "See [it](/cache-target)", title="Linking Page")
+        r = self.get("/cache-target/")
+        self.assertIsNone(r.headers.get("X-Cache"))
+        self.assertIn(b"Linking Page", r.data)
+
+    def test_renamed_backlink_invalidates(self):
+        support.create_page("cache-renamed-target")
+        linking = support.create_page("cache-renamed", "See [it](/cache-renamed-target)", title="Old Title")
+        etag = self.get("/cache-renamed-target/").headers["ETag"]
+
+        support.login(self.client)
+        with mock.patch.dict(app.app.config, {"WTF_CSRF_ENABLED": False}):
+            r = self.client.post("/edit/{0}/".format(linking.id), data={"url": linking.url,
+                "title": "New Title", "tags": "", "text": linking.latest.text, "comment": ""})
+        self.assertEqual(r.status_code, 302)
+        self.client = app.app.test_client()
+
+        r = self.client.get("/cache-renamed-target/", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.headers.get("X-Cache"))
+        self.assertIn(b"New Title", r.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Tests for revision diffs.
+
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+
+import support
+import app
+
+
+class DiffTestCase(unittest.TestCase):
+    def test_compute_diff(self):
+        old = "".join("line {0}\n".format(i) for i in range(10))
+        new = old.replace("line 5\n", "line five\n") + "line 10\n"
+        rows, added, removed = app.compute_diff(old, new, context=1)
+        self.assertEqual((added, removed), (2, 1))
+        kinds = [row[0] for row in rows]
+        self.assertEqual(kinds, ["skip", "ctx", "mod", "ctx", "skip", "ctx", "ins"])
+        self.assertEqual(rows[2][3], ([["=", "line "], ["-", "5"]], [["=", "line "], ["+", "five"]]))
+
+    def test_consecutive_diffs_are_stored(self):
+        p = support.create_page("diff-stored", "one\ntwo\n")
+        with app.app.test_request_context():
+            second = p.add_revision("one\n2\n", user_id=support.admin.id)
+            third = p.add_revision("one\n2\nthree\n", user_id=support.admin.id)
+        first = app.PageRevision.get((app.PageRevision.page == p) & (app.PageRevision.id < second.id))
+        diff = app.PageDiff.get_or_compute(first, second)
+        self.assertEqual((diff.added, diff.removed), (1, 1))
+        self.assertTrue(app.PageDiff.select().where(
+            (app.PageDiff.old == first) & (app.PageDiff.new == second)).exists())
+        # other pairs are not stored
+        app.PageDiff.get_or_compute(first, third)
+        self.assertFalse(app.PageDiff.select().where(
+            (app.PageDiff.old == first) & (app.PageDiff.new == third)).exists())
+
+    def test_diff_views(self):
+        p = support.create_page("diff-view", "Old line\n")
+        with app.app.test_request_context():
+            rev = p.add_revision("New line\n", user_id=support.admin.id)
+        client = app.app.test_client()
+        r = client.get("/history/diff/{0}/".format(rev.id))
+        self.assertEqual(r.status_code, 302)
+        r = client.get(r.headers["Location"])
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b"<ins>New</ins>", r.data)
+        other = support.create_page("diff-other")
+        self.assertEqual(client.get("/history/diff/{0}/{1}/".format(other.latest.id, rev.id)).status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests for Importer.
+
+Run with: python -m unittest discover tests
+"""
+
+import json, sqlite3, unittest
+
+import support
+import app
+
+
+def page(url, *texts, title=None):
+    return {"url": url, "title": title or url, "tags": [],
+        "history": [{"text": text, "timestamp": 1600000000 + k} for k, text in enumerate(texts)]}
+
+
+def run_import(pages, **kwargs):
+    importer = app.Importer(json.dumps({"pages": pages}), **kwargs)
+    importer.claim(support.admin)
+    with app.app.test_request_context():
+        return importer.execute()
+
+
+class ImporterTestCase(unittest.TestCase):
+    def test_import_pages_and_history(self):
+        self.assertEqual(run_import([page("import-one", "First", "Second"), page("import-two", "Other")]), (2, 3))
+        p = app.Page.get(app.Page.url == "import-one")
+        self.assertEqual(p.latest.text, "Second")
+        self.assertEqual(p.revisions.count(), 2)
+
+    def test_duplicate_url_goes_to_last_page(self):
+        self.assertEqual(run_import([page("import-dup", "a", title="First"),
+            page("import-dup", "b", title="Second")]), (2, 2))
+        self.assertEqual(app.Page.get(app.Page.url == "import-dup").title, "Second")
+        self.assertIsNone(app.Page.get(app.Page.title == "First").url)
+
+    def test_bad_text_skips_only_its_page(self):
+        # valid JSON, but a lone surrogate cannot be stored
+        self.assertEqual(run_import([page("import-valid", "Fine"), page("import-invalid", "x\ud800")]), (1, 1))
+        self.assertIsNotNone(app.Page.get_or_none(app.Page.url == "import-valid"))
+        self.assertIsNone(app.Page.get_or_none(app.Page.url == "import-invalid"))
+
+    def test_long_histories_stay_within_sql_limits(self):
+        # the limit of SQLite before 3.32; the connection is closed at the
+        # end of the import, and the next one has the default limit again
+        app.database.connection().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        pages = [page("import-long-{0}".format(i), *["Text {0} {1}".format(i, k) for k in range(30)])
+            for i in range(50)]
+        self.assertEqual(run_import(pages), (50, 1500))
+        self.assertTrue(app.database.is_closed())
+
+
+if __name__ == "__main__":
+    unittest.main()
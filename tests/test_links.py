@@ -0,0 +1,70 @@
+"""
+Tests for PageLink and the in-memory link graph.
+
+Run with: python -m unittest discover tests
+"""
+
+import json, unittest
+from unittest import mock
+
+import support
+import app
+
+
+def links_from(p):
+    return {i for i, in app.PageLink.select(app.PageLink.to_page).where(app.PageLink.from_page == p).tuples()}
+
+
+def wanted_from(p):
+    return {u for u, in app.PageWantedLink.select(app.PageWantedLink.url).where(app.PageWantedLink.from_page == p).tuples()}
+
+
+class LinkTestCase(unittest.TestCase):
+    def test_wanted_link_resolved_on_create(self):
+        linking = support.create_page("links-early", "See [later](/links-later)")
+        self.assertEqual(wanted_from(linking), {"links-later"})
+        later = support.create_page("links-later")
+        self.assertEqual(links_from(linking), {later.id})
+        self.assertEqual(wanted_from(linking), set())
+
+    def test_imported_pages_have_links(self):
+        linking = support.create_page("links-before-import", "See [it](/links-imported)")
+        importer = app.Importer(json.dumps({"pages": [{"url": "links-imported", "title": "Imported",
+            "history": [{"text": "Back to [it](/links-before-import)", "timestamp": 1600000000}]}]}))
+        importer.claim(support.admin)
+        with app.app.test_request_context():
+            self.assertEqual(importer.execute(), (1, 1))
+        imported = app.Page.get(app.Page.url == "links-imported")
+        self.assertEqual(links_from(imported), {linking.id})
+        self.assertEqual(links_from(linking), {imported.id})
+        self.assertNotIn("links-imported", dict(app.link_graph.wanted_links()))
+
+
+class LinkGraphTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(app, "link_graph", app.LinkGraph())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_orphans_and_importance(self):
+        hub = support.create_page("graph-hub")
+        spoke = support.create_page("graph-spoke", "To the [hub](/graph-hub)")
+        self.assertIn(spoke.id, app.link_graph.orphans())
+        self.assertNotIn(hub.id, app.link_graph.orphans())
+        ranks = app.link_graph.importance()
+        self.assertGreater(ranks[hub.id], ranks[spoke.id])
+        self.assertAlmostEqual(sum(ranks.values()), 1.0)
+
+    def test_dangling_links_are_skipped(self):
+        p = support.create_page("graph-dangling")
+        app.PageLink.insert(from_page=p.id, to_page=999999).execute()
+        app.PageLink.insert(from_page=999998, to_page=p.id).execute()
+        try:
+            self.assertIn(p.id, app.link_graph.orphans())
+            self.assertEqual(app.app.test_client().get("/p/important/").status_code, 200)
+        finally:
+            app.PageLink.delete().where(app.PageLink.from_page.in_([p.id, 999998])).execute()
+
+
+if __name__ == "__main__":
+    unittest.main()
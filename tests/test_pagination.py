@@ -0,0 +1,59 @@
+"""
+Tests for keyset (cursor) pagination.
+
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+
+import support
+import app
+
+
+class KeysetTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ids = [support.create_page("paging-{0}".format(i)).id for i in range(7)]
+
+    def query(self):
+        return app.Page.select().where(app.Page.url.startswith("paging-"))
+
+    def test_pages_cover_all_items_once(self):
+        fields = (app.Page.touched, app.Page.id)
+        seen, cursor = [], None
+        while True:
+            items, cursor = app.keyset_paginate(self.query(), fields, cursor=cursor, limit=3, descending=True)
+            seen.extend(p.id for p in items)
+            if not cursor:
+                break
+        self.assertEqual(seen, self.ids[::-1])
+
+    def test_window_goes_back(self):
+        fields = (app.Page.touched, app.Page.id)
+        first, prev_cursor, next_cursor = app.keyset_window(self.query(), fields, limit=3)
+        self.assertIsNone(prev_cursor)
+        second, prev_cursor, next_cursor = app.keyset_window(self.query(), fields, after=next_cursor, limit=3)
+        self.assertEqual([p.id for p in second], self.ids[3:6])
+        back, prev_cursor, next_cursor = app.keyset_window(self.query(), fields, before=prev_cursor, limit=3)
+        self.assertEqual([p.id for p in back], [p.id for p in first])
+        self.assertIsNone(prev_cursor)
+
+    def test_cursor_round_trip(self):
+        p = app.Page[self.ids[0]]
+        fields = (app.Page.touched, app.Page.id)
+        self.assertEqual(app.decode_cursor(app.encode_cursor([p.touched, p.id]), fields), [p.touched, p.id])
+
+    def test_bad_cursors_are_rejected(self):
+        client = app.app.test_client()
+        fields = (app.Page.touched, app.Page.id)
+        for values in ([1, 2], ["2020-01-01 00:00:00", "1"], ["2020-01-01 00:00:00", True], ["x", 1]):
+            with self.assertRaises(ValueError):
+                app.decode_cursor(app.encode_cursor(values), fields)
+            cursor = app.encode_cursor(values)
+            self.assertEqual(client.get("/p/most_recent/?after=" + cursor).status_code, 400)
+            self.assertEqual(client.get("/_jsoninfo/changed/0.0?cursor=" + cursor).status_code, 400)
+        self.assertEqual(client.get("/_jsoninfo/changed/0.0?cursor=x").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests for PageText storage: deduplication and deltas.
+
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+from unittest import mock
+
+import support
+import app
+
+
+def long_text(version, name=""):
+    # texts of each test must differ, or they are shared
+    return "".join("Line {0} of a long enough page text{1}.\n".format(i, name) for i in range(200)) + \
+        "Version {0}.\n".format(version)
+
+
+class StorageTestCase(unittest.TestCase):
+    def enable_deltas(self, keyframe_interval=20):
+        getconf = app._getconf
+        settings = {("storage", "deltas"): 1, ("storage", "keyframe_interval"): keyframe_interval}
+        patcher = mock.patch.object(app, "_getconf",
+            lambda k1, k2, fallback=None, cast=None: settings.get((k1, k2), getconf(k1, k2, fallback, cast)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_identical_texts_are_stored_once(self):
+        a = app.PageText.create_content("Same text in two pages")
+        b = app.PageText.create_content("Same text in two pages")
+        self.assertEqual(a.id, b.id)
+
+    def test_deltas_round_trip(self):
+        self.enable_deltas()
+        p = support.create_page("storage-deltas", long_text(0, "deltas"))
+        with app.app.test_request_context():
+            for version in range(1, 5):
+                p.add_revision(long_text(version, "deltas"), user_id=support.admin.id)
+        revs = list(p.revisions.order_by(app.PageRevision.id))
+        self.assertTrue(all(rev.textref.is_delta for rev in revs[1:]))
+        self.assertEqual([rev.text for rev in revs], [long_text(v, "deltas") for v in range(5)])
+
+    def test_keyframe_interval(self):
+        self.enable_deltas(keyframe_interval=3)
+        p = support.create_page("storage-keyframes", long_text(0, "keyframes"))
+        with app.app.test_request_context():
+            for version in range(1, 6):
+                p.add_revision(long_text(version, "keyframes"), user_id=support.admin.id)
+        flags = [rev.textref.is_delta for rev in p.revisions.order_by(app.PageRevision.id)]
+        self.assertEqual(flags, [False, True, True, False, True, True])
+
+    def test_repack(self):
+        p = support.create_page("storage-repack", long_text(0, "repack"))
+        with app.app.test_request_context():
+            for version in range(1, 5):
+                p.add_revision(long_text(version, "repack"), user_id=support.admin.id)
+        self.enable_deltas()
+        size_before, size_after = app.PageText.repack()
+        self.assertLess(size_after, size_before)
+        revs = list(p.revisions.order_by(app.PageRevision.id))
+        self.assertTrue(all(app.PageText[rev.textref_id].is_delta for rev in revs[1:]))
+        self.assertEqual([app.PageRevision[rev.id].text for rev in revs], [long_text(v, "repack") for v in range(5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
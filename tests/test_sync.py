@@ -0,0 +1,136 @@
+"""
+Tests for app_sync, against the app itself as master.
+
+Run with: python -m unittest discover tests
+"""
+
+import os, unittest
+from urllib.parse import urlsplit
+from unittest import mock
+
+import support
+import app
+import app_sync
+
+# master and replica share the database: the replica copy of master
+# page i (100 <= i < REPLICA_OFFSET) is page i + REPLICA_OFFSET
+REPLICA_OFFSET = 1000
+
+
+def create_master_page(i, text="Hello"):
+    return support.create_page("master-{0}".format(i), text, title="Page {0}".format(i), page_id=i)
+
+
+class Response(object):
+    def __init__(self, data, status_code=200):
+        self._data = data
+        self.status_code = status_code
+    def json(self):
+        return self._data
+
+
+class AppMaster(object):
+    """
+    Forward requests to app.test_client(), moving master pages to the
+    replica ids. tamper(pageinfo) can alter the pages sent.
+    """
+    def __init__(self, tamper=None):
+        self.client = app.app.test_client()
+        self.tamper = tamper
+
+    def _forward(self, method, url, **kwargs):
+        parts = urlsplit(url)
+        r = getattr(self.client, method)(parts.path + ("?" + parts.query if parts.query else ""), **kwargs)
+        data = r.get_json()
+        if r.status_code >= 400 or data is None:
+            return Response(data, r.status_code)
+        if "ids" in data:
+            data["ids"] = [i + REPLICA_OFFSET for i in data["ids"] if 100 <= i < REPLICA_OFFSET]
+        pages = data.get("pages", [data] if "id" in data else [])
+        for p in pages:
+            p["id"] += REPLICA_OFFSET
+            p["url"] = "synced-{0}".format(p["id"])
+            if self.tamper:
+                self.tamper(p)
+        return Response(data, r.status_code)
+
+    def _master_ids(self, ids):
+        return ",".join(str(int(i) - REPLICA_OFFSET) for i in ids.split(","))
+
+    def get(self, url, params=None):
+        if params and "ids" in params:
+            params = dict(params, ids=self._master_ids(params["ids"]))
+        return self._forward("get", url, query_string=params)
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        checkpoint_dir = support.tempdir()
+        patcher = mock.patch.object(app_sync, "_checkpoint_path",
+            lambda: os.path.join(checkpoint_dir, "last_sync"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app.Page.delete().where(app.Page.id >= 100).execute()
+
+    def test_sync_copies_pages(self):
+        for i in (101, 102):
+            create_master_page(i, text="Text of {0}".format(i))
+        client = app_sync.SyncClient("http://master", session=AppMaster(), workers=2)
+
+        self.assertEqual(client.sync(), (2, 0))
+        self.assertEqual(app.Page[1102].title, "Page 102")
+        self.assertEqual(app.Page[1102].latest.text, "Text of 102")
+
+    def test_synced_pages_have_links(self):
+        # replica ids, see AppMaster
+        create_master_page(101, text="See [next](/p/1102)")
+        create_master_page(102)
+        client = app_sync.SyncClient("http://master", session=AppMaster(), batch_size=1)
+
+        self.assertEqual(client.sync(), (2, 0))
+        self.assertTrue(app.PageLink.select().where(
+            (app.PageLink.from_page == 1101) & (app.PageLink.to_page == 1102)).exists())
+
+    def test_bad_page_does_not_block_sync(self):
+        for i in (101, 102, 103):
+            create_master_page(i)
+        def tamper(p):
+            if p["id"] == 1102:
+                p["latest"]["length"] = 99
+        client = app_sync.SyncClient("http://master", session=AppMaster(tamper),
+            workers=2, batch_size=2)
+        client.max_attempts = 2
+
+        self.assertEqual(client.sync(), (2, 1))
+        self.assertEqual(app_sync.load_failed(), {1102: 1})
+        self.assertIsNone(app_sync.load_checkpoint()[1])
+
+        # newer changes still come through, and the bad page is given up
+        create_master_page(104)
+        self.assertEqual(client.sync(), (1, 1))
+        self.assertIsNotNone(app.Page.get_or_none(app.Page.id == 1104))
+        self.assertIsNone(app.Page.get_or_none(app.Page.id == 1102))
+        self.assertEqual(app_sync.load_failed(), {})
+
+    def test_failed_fetch_is_not_counted_as_passed(self):
+        create_master_page(101)
+        master = AppMaster()
+        with mock.patch.object(master, "_master_ids", lambda ids: "x"):
+            self.assertEqual(app_sync.SyncClient("http://master", session=master).sync(), (0, 1))
+
+    def test_old_master_is_reported(self):
+        create_master_page(101)
+        master = AppMaster()
+        client = app_sync.SyncClient("http://master", session=master)
+        with mock.patch.object(master, "_forward", lambda method, url, **kwargs: Response(None, 404)):
+            with self.assertRaisesRegex(RuntimeError, "0.9 or later"):
+                client.fetch_batch([1101])
+
+    def test_fetch_size_is_clamped(self):
+        with mock.patch.object(app_sync, "_getconf", lambda k1, k2, fallback=None, cast=None: 1000):
+            client = app_sync.SyncClient("http://master", session=AppMaster())
+        self.assertEqual(client.fetch_size, app.JSONINFO_BATCH_LIMIT)
+
+
+if __name__ == "__main__":
+    unittest.main()
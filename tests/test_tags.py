@@ -0,0 +1,49 @@
+"""
+Tests for tag statistics.
+
+Run with: python -m unittest discover tests
+"""
+
+import unittest
+
+import support
+import app
+
+
+def count(tag):
+    stat = app.TagStat.get_or_none(app.TagStat.name == tag)
+    return stat.count if stat else 0
+
+
+class TagStatTestCase(unittest.TestCase):
+    def test_counts_follow_tag_changes(self):
+        a = support.create_page("tags-a", tags=["stat-one", "stat-two"])
+        support.create_page("tags-b", tags=["stat-one"])
+        self.assertEqual((count("stat-one"), count("stat-two")), (2, 1))
+        with app.app.test_request_context():
+            a.change_tags(["stat-one", "stat-three"])
+        self.assertEqual((count("stat-one"), count("stat-two"), count("stat-three")), (2, 0, 1))
+        self.assertIsNone(app.TagStat.get_or_none(app.TagStat.name == "stat-two"))
+
+    def test_refresh_all_matches_counts(self):
+        support.create_page("tags-refresh", tags=["stat-refresh"])
+        app.TagStat.update(count=42).where(app.TagStat.name == "stat-refresh").execute()
+        app.TagStat.refresh_all()
+        self.assertEqual(count("stat-refresh"), 1)
+
+    def test_complete(self):
+        support.create_page("tags-complete-a", tags=["complete-popular", "complete-rare"])
+        support.create_page("tags-complete-b", tags=["complete-popular"])
+        r = app.app.test_client().get("/_jsoninfo/tags?q=%23complete")
+        self.assertEqual([t["name"] for t in r.get_json()["tags"]], ["complete-popular", "complete-rare"])
+        self.assertEqual(r.get_json()["tags"][0]["count"], 2)
+
+    def test_tag_index(self):
+        support.create_page("tags-index", tags=["stat-index"])
+        r = app.app.test_client().get("/tags/")
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b"stat-index", r.data)
+
+
+if __name__ == "__main__":
+    unittest.main()